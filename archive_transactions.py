@@ -0,0 +1,44 @@
+"""Move old transactions to monthly archive tables, run from the project root, e.g. daily by cron:
+
+    python3 -m archive_transactions --archive_after_days=180
+
+Transactions created more than archive_after_days ago are moved batch by batch from the transaction table of every
+shard to transaction_YYYYMM tables, each batch in its own database transaction, so the hot table and its indexes stay
+small. The transaction lists of sellers and customers still read the archived transactions, see
+Seller.list_transactions_by_page and Customer.list_transactions.
+"""
+from datetime import datetime, timedelta
+import logging
+import time
+
+import tornado.options
+
+tornado.options.define('archive_batch_size', default=1000, type=int)
+tornado.options.define('archive_batch_interval', default=0.05, type=float)
+
+import config
+from tornado.options import options
+
+from core import models
+from urvip.models import Transaction
+
+
+def archive_transactions(db, before):
+    """Archive transactions created before the given time in batches, returns the number of archived transactions.
+    """
+    archived = 0
+    while True:
+        count = Transaction.archive(db, before, options.archive_batch_size)
+        if not count:
+            return archived
+        archived += count
+        time.sleep(options.archive_batch_interval)
+
+
+if __name__ == '__main__':
+    models.init()
+    before = datetime.now() - timedelta(days=options.archive_after_days)
+    for shard in models.shards():
+        db = models.shard_database(shard)
+        logging.info('Archiving transactions before {0} of shard {1}.'.format(before, shard))
+        logging.info('Archived {0} transactions of shard {1}.'.format(archive_transactions(db, before), shard))
@@ -0,0 +1,135 @@
+"""Check the query plans of the model queries, run from the project root against a seeded database:
+
+    python3 -m benchmarks.explain --database_url=sqlite:////tmp/urvip-benchmark.db --debug=false
+
+Runs each model query, EXPLAINs the SELECT statements it issued and exits with status 1 if any plan falls back to
+a full table scan or a filesort. Seed with benchmarks.seed first, plans of empty tables are meaningless. Archive part
+of the transactions too, e.g. with archive_transactions --archive_after_days=90, otherwise the queries of the monthly
+archive tables are skipped.
+"""
+from datetime import datetime
+import sys
+
+import config
+from sqlalchemy import event
+
+from core import models
+from urvip import analytics
+from urvip.models import Seller, Admin, ChargeRule, Customer, Transaction, TransactionArchive, CustomerArchive
+
+
+def capture_statements(engine, call):
+    """Returns the SELECT statements and parameters issued by call().
+    """
+    statements = []
+
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        call()
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return statements
+
+
+def explain(engine, statement, parameters):
+    """Returns the plan of the statement as a list of dicts.
+    """
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        prefix = 'EXPLAIN QUERY PLAN ' if engine.dialect.name == 'sqlite' else 'EXPLAIN '
+        cursor.execute(prefix + statement, parameters)
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+def find_problems(dialect_name, plan):
+    """Returns the steps of the plan that scan a whole table or sort without an index.
+    """
+    problems = []
+    for step in plan:
+        if dialect_name == 'sqlite':
+            detail = step['detail']
+            if (detail.startswith('SCAN') and 'USING' not in detail and 'SUBQUERY' not in detail) or \
+                    'TEMP B-TREE' in detail:
+                problems.append(detail)
+        else:
+            extra = step.get('Extra') or ''
+            # Scanning a derived table, e.g. the subquery of Query.count(), is not a table scan.
+            if (step['type'] == 'ALL' and not str(step['table']).startswith('<derived')) or \
+                    'Using filesort' in extra or 'Using temporary' in extra:
+                problems.append('{0}: type={1} {2}'.format(step['table'], step['type'], extra))
+    return problems
+
+
+def checks(db):
+    """Model queries to check, each one called with IDs taken from the seeded data.
+    """
+    customer = db.query(Customer.id, Customer.sellerId, Customer.card, Customer.cellphone).first()
+    admin = db.query(Admin.cellphone).first()
+    return [
+        ('Customer.get(id)', lambda: Customer.get(db, customer.sellerId, id=customer.id)),
+        ('Customer.get(card)', lambda: Customer.get(db, customer.sellerId, card=customer.card)),
+        ('Customer.get(cellphone)', lambda: Customer.get(db, customer.sellerId, cellphone=customer.cellphone)),
+        ('Customer.get_validator', lambda: Customer.get_validator(db, customer.sellerId, id=customer.id)),
+        ('Customer.list_by_page', lambda: Customer.list_by_page(db, customer.sellerId, 3)),
+        ('Customer.list_transactions', lambda: Customer.list_transactions(db, customer.id)),
+        ('Seller.list_transactions_by_page', lambda: Seller.list_transactions_by_page(db, customer.sellerId, 3)),
+        ('ChargeRule.list', lambda: ChargeRule.list(db, customer.sellerId)),
+        ('Customer.list_changes', lambda: Customer.list_changes(db, customer.sellerId, datetime(1970, 1, 1), 0,
+                                                                datetime.now())),
+        ('ChargeRule.list_changes', lambda: ChargeRule.list_changes(db, customer.sellerId, datetime(1970, 1, 1), 0,
+                                                                    datetime.now())),
+        ('Admin by cellphone', lambda: db.query(Admin).filter(Admin.cellphone == admin.cellphone,
+                                                              Admin.status == 1).first()),
+        ('analytics first unsettled transaction',
+         lambda: analytics._first_unsettled_id(db, customer.sellerId, 0, datetime.now())),
+    ] + archive_checks(db)
+
+
+def archive_checks(db):
+    """Queries of the monthly archive tables, None for the call when nothing is archived yet.
+    """
+    seller_archive = db.query(TransactionArchive).filter(TransactionArchive.count > 0).first()
+    customer_archive = db.query(CustomerArchive).filter(CustomerArchive.count > 0).first()
+    if seller_archive is None or customer_archive is None:
+        return [('archive tables', None)]
+    seller_id = seller_archive.sellerId
+    hot_count = db.query(Transaction.id).filter(Transaction.sellerId == seller_id).count()
+    return [
+        # The first page past the transactions not archived yet.
+        ('Seller.list_transactions_by_page archived',
+         lambda: Seller.list_transactions_by_page(db, seller_id, hot_count // 10 + 1)),
+        ('Customer.list_transactions archived',
+         lambda: Customer.list_transactions(db, customer_archive.customerId, limit=10 ** 6)),
+        ('analytics stream transactions',
+         lambda: list(analytics._stream_transactions(db, seller_id, 0, None, 10000))),
+    ]
+
+
+def main():
+    models.init()
+    engine, db = models.engine(), models.read_write_database()
+    failed = False
+    for name, call in checks(db):
+        if call is None:
+            print('SKIP {0}: nothing archived'.format(name))
+            continue
+        for statement, parameters in capture_statements(engine, call):
+            problems = find_problems(engine.dialect.name, explain(engine, statement, parameters))
+            print('{0} {1}'.format('FAIL' if problems else 'OK  ', name))
+            for problem in problems:
+                print('    {0}'.format(problem))
+            failed = failed or bool(problems)
+        db.rollback()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
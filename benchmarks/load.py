@@ -0,0 +1,208 @@
+"""Load test the urvip endpoints against local stand-ins, run from the project root:
+
+    python3 -m benchmarks.load --database_url=sqlite:////tmp/urvip-benchmark.db --redis_fake=true \
+        --oss_local_path=/tmp/urvip-oss --cookie_secret=benchmark --debug=false --benchmark_admins_per_seller=16 \
+        --benchmark_concurrency=16 --benchmark_duration=30
+
+Seeds the database, starts main in a subprocess with the same options, drives the scenarios concurrently and
+prints throughput, p50 and p99 of each scenario as JSON, so that runs can be compared. Each virtual user logs in as
+its own admin, so concurrency is capped at sellers * admins per seller. Use a local Redis instead of
+--redis_fake=true when --num_processes is greater than 1, fakeredis is not shared between workers. Install
+requirements-dev.txt for fakeredis.
+"""
+from urllib.parse import urlencode
+import json
+import subprocess
+import sys
+import time
+
+import tornado.options
+
+tornado.options.define('benchmark_concurrency', default=8, type=int)
+tornado.options.define('benchmark_duration', default=30, type=float)
+tornado.options.define('benchmark_scenarios', default='customers:4,customerDetail:2,charge:1,consume:1', type=str)
+tornado.options.define('benchmark_output', default='', type=str)
+tornado.options.define('benchmark_skip_seed', default=False, type=bool)
+
+from benchmarks.seed import seed, create_tables, admin_cellphone, CAPTCHA
+from tornado.options import options
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+import tornado.ioloop
+
+from core import models
+from urvip.models import ChargeRule, Customer
+
+
+# Options passed through to the server.
+_server_options = ['port', 'num_processes', 'debug', 'cookie_secret', 'database_url', 'redis_fake', 'oss_local_path',
+                   'mysql_host', 'mysql_port', 'mysql_database', 'mysql_user', 'mysql_password',
+                   'redis_session_db_host', 'redis_session_db_port', 'redis_session_db_database',
+                   'redis_cache_db_host', 'redis_cache_db_port', 'redis_cache_db_database',
+                   'max_in_flight_requests', 'max_queue_delay', 'shard_database_urls']
+
+
+class VirtualUser(object):
+    """Logs in as one admin and works on customers nobody else touches, so that charges never conflict.
+    """
+    def __init__(self, db, base_url, seller_id, cellphone, customer_ids, charge_rule_id):
+        self.db = db
+        self.base_url = base_url
+        self.seller_id = seller_id
+        self.cellphone = cellphone
+        self.customer_ids = customer_ids
+        self.charge_rule_id = charge_rule_id
+        self.cookie = None
+        self.requests = 0
+
+    @gen.coroutine
+    def login(self, client):
+        response = yield client.fetch(self.base_url + '/login', method='POST', follow_redirects=False,
+                                      raise_error=False,
+                                      body=urlencode({'cellphone': self.cellphone, 'captcha': CAPTCHA}))
+        cookies = [c.split(';')[0] for c in response.headers.get_list('Set-Cookie')]
+        if not cookies:
+            raise Exception('Failed to log in as {0}.'.format(self.cellphone))
+        self.cookie = '; '.join(cookies)
+
+    def next_customer_id(self):
+        self.requests += 1
+        return self.customer_ids[self.requests % len(self.customer_ids)]
+
+    def update_time(self, customer_id):
+        # The harness reads the optimistic lock value directly, outside the measured request.
+        self.db.rollback()
+        return self.db.query(Customer.updateTime).filter(Customer.id == customer_id).scalar().timestamp()
+
+    def build_request(self, scenario):
+        """Returns method, path and body of the scenario.
+        """
+        if scenario == 'customers':
+            return 'GET', '/customers?page={0}'.format(self.requests % 10), None
+        customer_id = self.next_customer_id()
+        if scenario == 'customerDetail':
+            return 'GET', '/customerDetail?id={0}'.format(customer_id), None
+        elif scenario == 'charge':
+            return 'POST', '/charge', urlencode({'customerId': customer_id,
+                                                 'updateTime': repr(self.update_time(customer_id)),
+                                                 'chargeRuleId': self.charge_rule_id, 'comments': 'benchmark'})
+        elif scenario == 'consume':
+            return 'POST', '/consume', urlencode({'customerId': customer_id,
+                                                  'updateTime': repr(self.update_time(customer_id)),
+                                                  'scoreChange': -1, 'comments': 'benchmark'})
+        raise Exception('Unknown scenario {0}.'.format(scenario))
+
+
+def parse_scenarios(value):
+    """Parse 'name:weight,...' into a list of names repeated by weight.
+    """
+    scenarios = []
+    for item in value.split(','):
+        name, weight = item.split(':')
+        scenarios.extend([name] * int(weight))
+    return scenarios
+
+
+@gen.coroutine
+def drive(users, scenarios, duration):
+    """Run every virtual user concurrently for duration seconds, returns latencies and errors of each scenario.
+    """
+    client = AsyncHTTPClient(max_clients=len(users))
+    for user in users:
+        yield user.login(client)
+    latencies = {name: [] for name in set(scenarios)}
+    errors = {name: 0 for name in set(scenarios)}
+    deadline = time.time() + duration
+
+    @gen.coroutine
+    def run(user, offset):
+        index = offset
+        while time.time() < deadline:
+            scenario = scenarios[index % len(scenarios)]
+            index += 1
+            method, path, body = user.build_request(scenario)
+            started_at = time.time()
+            response = yield client.fetch(user.base_url + path, method=method, body=body, raise_error=False,
+                                          follow_redirects=False, headers={'Cookie': user.cookie})
+            latencies[scenario].append(time.time() - started_at)
+            if response.code != 200 or (method == 'POST' and json.loads(response.body.decode('utf-8'))['status']):
+                errors[scenario] += 1
+
+    yield [run(user, i) for i, user in enumerate(users)]
+    return latencies, errors
+
+
+def summarize(latencies, errors, duration):
+    summary = dict()
+    for scenario, values in latencies.items():
+        values = sorted(values)
+        summary[scenario] = {'requests': len(values), 'errors': errors[scenario],
+                             'throughput': len(values) / duration,
+                             'p50Ms': _percentile(values, 0.5) * 1000, 'p99Ms': _percentile(values, 0.99) * 1000}
+    return summary
+
+
+def wait_for_server(base_url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            tornado.ioloop.IOLoop.current().run_sync(lambda: AsyncHTTPClient().fetch(base_url + '/login'))
+            return
+        except Exception:
+            time.sleep(0.1)
+    raise Exception('Server did not start in {0} seconds.'.format(timeout))
+
+
+def _format_option(value):
+    return ','.join(value) if isinstance(value, list) else value
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[int(fraction * (len(sorted_values) - 1))] if sorted_values else 0
+
+
+def main():
+    models.init()
+    db = models.read_write_database()
+    if not options.benchmark_skip_seed:
+        create_tables()
+        seller_ids = seed(db, options.benchmark_sellers, options.benchmark_admins_per_seller,
+                          options.benchmark_customers_per_seller, options.benchmark_transactions_per_customer,
+                          options.benchmark_batch_size, options.benchmark_random_seed)
+    else:
+        seller_ids = list(range(1, options.benchmark_sellers + 1))
+    # One virtual user per admin, each owning a disjoint slice of its seller's customers.
+    users = []
+    base_url = 'http://127.0.0.1:{0}'.format(options.port)
+    for seller_index, seller_id in enumerate(seller_ids):
+        shard_db = models.seller_database(seller_id)
+        customer_ids = [c.id for c in shard_db.query(Customer.id).filter(Customer.sellerId == seller_id)]
+        charge_rule_id = ChargeRule.list(shard_db, seller_id)[0].id
+        for admin_index in range(options.benchmark_admins_per_seller):
+            users.append(VirtualUser(shard_db, base_url, seller_id, admin_cellphone(seller_index, admin_index),
+                                     customer_ids[admin_index::options.benchmark_admins_per_seller],
+                                     charge_rule_id))
+    users = users[:options.benchmark_concurrency]
+    server = subprocess.Popen([sys.executable, '-m', 'main'] +
+                              ['--{0}={1}'.format(name, _format_option(getattr(options, name)))
+                               for name in _server_options])
+    try:
+        wait_for_server(base_url)
+        scenarios = parse_scenarios(options.benchmark_scenarios)
+        latencies, errors = tornado.ioloop.IOLoop.current().run_sync(
+            lambda: drive(users, scenarios, options.benchmark_duration))
+    finally:
+        server.terminate()
+        server.wait()
+    result = {'options': {name: getattr(options, name) for name in options.as_dict() if name.startswith('benchmark_')},
+              'numProcesses': options.num_processes, 'users': len(users),
+              'scenarios': summarize(latencies, errors, options.benchmark_duration)}
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if options.benchmark_output:
+        with open(options.benchmark_output, 'w') as output_file:
+            output_file.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
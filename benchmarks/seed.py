@@ -0,0 +1,104 @@
+"""Seed synthetic sellers, admins, charge rules, customers and transactions, run from the project root:
+
+    python3 -m benchmarks.seed --database_url=sqlite:///benchmark.db --benchmark_sellers=10
+
+Admins can log in with captcha 000000, see admin_cellphone().
+"""
+from datetime import datetime, timedelta
+from random import Random
+from uuid import uuid4
+
+import tornado.options
+
+tornado.options.define('benchmark_sellers', default=1, type=int)
+tornado.options.define('benchmark_admins_per_seller', default=1, type=int)
+tornado.options.define('benchmark_customers_per_seller', default=1000, type=int)
+tornado.options.define('benchmark_transactions_per_customer', default=10, type=int)
+tornado.options.define('benchmark_batch_size', default=1000, type=int)
+tornado.options.define('benchmark_random_seed', default=0, type=int)
+
+import config
+from tornado.options import options
+
+from core import models
+from urvip.models import Seller, Admin, ChargeRule, Customer, Transaction
+
+
+CAPTCHA = '000000'
+
+
+def admin_cellphone(seller_index, admin_index):
+    return '+86138{0:04d}{1:04d}'.format(seller_index, admin_index)
+
+
+def seed(db, sellers, admins_per_seller, customers_per_seller, transactions_per_customer, batch_size=1000,
+         random_seed=0):
+    """Insert the synthetic data with batched INSERTs, returns the seller IDs.
+
+    Rows are generated lazily and committed batch by batch, so millions of rows can be loaded in constant memory.
+    """
+    random = Random(random_seed)
+    now = datetime.now()
+    captcha_expire_time = now + timedelta(days=365)
+    seller_ids = []
+    for seller_index in range(sellers):
+        seller = Seller.add(db, 'seller{0}'.format(seller_index), '', score_rate=1)
+        seller_ids.append(seller.id)
+        for admin_index in range(admins_per_seller):
+            db.add(Admin(sellerId=seller.id, cellphone=admin_cellphone(seller_index, admin_index),
+                         cellphoneAuthCaptcha=CAPTCHA, cellphoneAuthCaptchaExpireTime=captcha_expire_time,
+                         status=1, createTime=now, updateTime=now))
+        db.commit()
+        # Charge rules, customers and transactions live in the seller's shard.
+        shard_db = models.seller_database(seller.id)
+        for payout in (100, 500, 1000):
+            shard_db.add(ChargeRule(sellerId=seller.id, name='charge{0}'.format(payout), payout=payout,
+                                    balanceChange=payout * 1.1, quantityChange=0, scoreChange=payout // 10,
+                                    status=1, createTime=now, updateTime=now))
+        shard_db.commit()
+        _insert(shard_db, Customer, (
+            dict(sellerId=seller.id, identification='', name='customer{0}'.format(i), gender=1 + i % 2,
+                 cellphone='+86139{0:04d}{1:08d}'.format(seller_index, i), weChatOpenId='',
+                 card=str(uuid4()).replace('-', ''), address='', zipCode='', balance=1000, quantity=0, score=1000,
+                 level=1, status=1, createTime=now, updateTime=now - timedelta(seconds=i))
+            for i in range(customers_per_seller)), batch_size)
+        customer_ids = [c.id for c in shard_db.query(Customer.id).filter(Customer.sellerId == seller.id)]
+        _insert(shard_db, Transaction, (
+            dict(customerId=customer_id, sellerId=seller.id, kind=1 if t % 2 == 0 else 5, balanceChange=0, balance=0,
+                 quantityChange=0, quantity=0, scoreChange=0, score=0, comments='',
+                 createTime=now - timedelta(minutes=random.randint(0, 365 * 24 * 60)))
+            for customer_id in customer_ids for t in range(transactions_per_customer)), batch_size)
+    return seller_ids
+
+
+def _insert(db, model, rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            db.execute(model.__table__.insert(), _to_columns(model, batch))
+            db.commit()
+            batch = []
+    if batch:
+        db.execute(model.__table__.insert(), _to_columns(model, batch))
+        db.commit()
+
+
+def _to_columns(model, rows):
+    # Rows are keyed by attribute names, the table expects column names.
+    names = {attribute: getattr(model, attribute).property.columns[0].name for attribute in rows[0]}
+    return [{names[attribute]: value for attribute, value in row.items()} for row in rows]
+
+
+def create_tables():
+    models.BaseModel.metadata.create_all(models.engine())
+    for shard in range(models.shard_count()):
+        models.BaseModel.metadata.create_all(models.shard_engine(shard))
+
+
+if __name__ == '__main__':
+    models.init()
+    create_tables()
+    print(seed(models.read_write_database(), options.benchmark_sellers, options.benchmark_admins_per_seller,
+               options.benchmark_customers_per_seller, options.benchmark_transactions_per_customer,
+               options.benchmark_batch_size, options.benchmark_random_seed))
@@ -0,0 +1,64 @@
+"""Measure worker startup, run from the project root:
+
+    python3 -m benchmarks.startup --num_processes=4
+
+Starts main with the given options and prints the import, init and time-to-first-request of each worker as JSON.
+"""
+from threading import Thread
+import argparse
+import json
+import re
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+
+_started_pattern = re.compile('Worker ([0-9]+) started: imports ([0-9.]+) ms, init ([0-9.]+) ms')
+_first_request_pattern = re.compile('Worker ([0-9]+) served first request ([0-9.]+) ms after start')
+
+
+def measure(port, num_processes, timeout):
+    workers = dict()
+    process = subprocess.Popen([sys.executable, '-m', 'main', '--port={0}'.format(port),
+                                '--num_processes={0}'.format(num_processes), '--debug=false', '--logging=info'],
+                               stderr=subprocess.PIPE, universal_newlines=True)
+    Thread(target=_read_log, args=(process.stderr, workers), daemon=True).start()
+    launched_at = time.time()
+    try:
+        # Requests are spread over workers by the kernel, keep sending until every worker has served one.
+        while time.time() - launched_at < timeout:
+            served = [w for w in workers.values() if 'firstRequestMs' in w]
+            if len(served) >= num_processes:
+                break
+            try:
+                with urllib.request.urlopen('http://127.0.0.1:{0}/login'.format(port), timeout=1):
+                    pass
+            except (urllib.error.URLError, OSError):
+                time.sleep(0.01)
+    finally:
+        process.terminate()
+        process.wait()
+    return {'numProcesses': num_processes, 'workers': sorted(workers.values(), key=lambda w: w['pid'])}
+
+
+def _read_log(stream, workers):
+    for line in stream:
+        match = _started_pattern.search(line)
+        if match:
+            worker = workers.setdefault(int(match.group(1)), {'pid': int(match.group(1))})
+            worker['importMs'], worker['initMs'] = float(match.group(2)), float(match.group(3))
+        match = _first_request_pattern.search(line)
+        if match:
+            worker = workers.setdefault(int(match.group(1)), {'pid': int(match.group(1))})
+            worker['firstRequestMs'] = float(match.group(2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure worker startup.')
+    parser.add_argument('--port', type=int, default=18000)
+    parser.add_argument('--num_processes', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=30)
+    arguments = parser.parse_args()
+    print(json.dumps(measure(arguments.port, arguments.num_processes, arguments.timeout), indent=2))
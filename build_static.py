@@ -0,0 +1,16 @@
+"""Fingerprint and precompress the static files, run from the project root before deploying:
+
+    python3 -m build_static
+
+main does the same on start unless --build_static_on_start=false, e.g. when the static directory is read-only.
+Serve static/build/ with nginx, see nginx.conf.sample, or let AssetHandler serve it.
+"""
+import os
+
+import config
+
+from core.assets import build
+
+
+if __name__ == '__main__':
+    build(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
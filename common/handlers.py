@@ -2,11 +2,14 @@ from io import BytesIO
 from uuid import uuid4
 import os
 
-from PIL import Image
-from mutagen import File as mutagenFile
+from tornado.options import options
+from tornado import gen
 
+from core.decorators import require_permissions
 from core.handlers import PageHandler, ApiHandler
 from core.utils.oss import upload_oss
+from core.utils.profiler import PROFILE_HEADER, SamplingProfiler, collapse, broadcast_sampling, \
+    enable_request_profiling, get_results, get_edges
 
 
 class HomePageHandler(PageHandler):
@@ -22,7 +25,10 @@ class HomePageHandler(PageHandler):
 class UploadImageHandler(ApiHandler):
     """Upload image, only GIF, JPEG and PNG formats are allowed.
     """
+    rate_limits = (('ip', 1, 10),)
+
     def post(self, *args, **kwargs):
+        from PIL import Image
         contents = self.request.files['file'][0]['body']
         if len(contents) > 2 * 1024 * 1024:
             return self.api_failed(4, 'Image file too large.')
@@ -37,7 +43,10 @@ class UploadImageHandler(ApiHandler):
 class UploadAudioHandler(ApiHandler):
     """Upload audio, only MP3 format is allowed.
     """
+    rate_limits = (('ip', 1, 10),)
+
     def post(self, *args, **kwargs):
+        from mutagen import File as mutagenFile
         contents = self.request.files['file'][0]['body']
         if len(contents) > 5 * 1024 * 1024:
             return self.api_failed(4, 'Audio file too large.')
@@ -52,7 +61,11 @@ class UploadAudioHandler(ApiHandler):
 class UploadVideoHandler(ApiHandler):
     """Upload video, only MP4 format is allowed.
     """
+    rate_limits = (('ip', 0.1, 3), ('route', 1, 4))
+
     def post(self, *args, **kwargs):
+        from PIL import Image
+        from mutagen import File as mutagenFile
         # Video
         video_contents = self.request.files['file'][0]['body']
         if len(video_contents) > 10 * 1024 * 1024:
@@ -87,9 +100,44 @@ class UploadVideoHandler(ApiHandler):
         return cover_contents, cover_extension
 
 
+class ProfileHandler(ApiHandler):
+    """Profile live workers, sampled stacks are returned in the collapsed format for flame graphs.
+
+    Requests profiled with cProfile return call edges instead, fetch them with mode=cprofile, see
+    core.utils.profiler.finish_request_profile(). Admins listed in profiler_admin_ids get the permission at login.
+    """
+    @require_permissions('profile')
+    @gen.coroutine
+    def post(self, *args, **kwargs):
+        mode = self.get_str_argument('mode', 'sample')
+        scope = self.get_str_argument('scope', 'local')
+        seconds = min(max(self.get_float_argument('seconds', 10.0), 0.1), options.profiler_max_seconds)
+        interval = max(self.get_float_argument('interval', 0.005), 0.001)
+        if mode == 'cprofile':
+            token = enable_request_profiling(seconds)
+            return self.api_succeed({'id': token, 'header': PROFILE_HEADER})
+        elif mode != 'sample':
+            return self.api_failed(4, 'Invalid profiling mode.')
+        if scope == 'all':
+            return self.api_succeed({'id': broadcast_sampling(seconds, interval)})
+        profiler = SamplingProfiler(interval)
+        profiler.start()
+        yield gen.sleep(seconds)
+        return self.api_succeed({'stacks': collapse(profiler.stop()), 'workers': 1})
+
+    @require_permissions('profile')
+    def get(self, *args, **kwargs):
+        if self.get_str_argument('mode', 'sample') == 'cprofile':
+            edges, workers = get_edges(self.get_str_argument('id'))
+            return self.api_succeed({'edges': edges, 'workers': workers})
+        stacks, workers = get_results(self.get_str_argument('id'))
+        return self.api_succeed({'stacks': stacks, 'workers': workers})
+
+
 __handlers__ = [
     (r'^/$', HomePageHandler),
     (r'^/uploadImage$', UploadImageHandler),
     (r'^/uploadAudio$', UploadAudioHandler),
-    (r'^/uploadVideo$', UploadVideoHandler)
+    (r'^/uploadVideo$', UploadVideoHandler),
+    (r'^/profile$', ProfileHandler)
 ]
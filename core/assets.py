@@ -0,0 +1,151 @@
+"""Fingerprinted, precompressed static assets.
+
+build() copies every file under the static directory to build/ with a content hash in its name, writes gzip and,
+if the brotli package is installed, brotli variants next to it and maps the original paths to the built ones in
+build/manifest.json. static_url() in templates then returns the built URL, which never changes content, so
+browsers and nginx cache it forever. Built files of earlier versions are kept, pages rendered before a deploy still
+reference them.
+"""
+from hashlib import md5
+import gzip
+import json
+import logging
+import mimetypes
+import os
+import re
+
+import tornado.web
+
+
+BUILD_DIRECTORY = 'build'
+MANIFEST_NAME = 'manifest.json'
+# Compressing these is pointless, they are compressed already.
+_COMPRESSED_TYPES = ('image/', 'audio/', 'video/', 'application/zip', 'application/gzip')
+# Built names end with the content hash and the extension, see build().
+_FINGERPRINT_PATTERN = re.compile(r'\.[0-9a-f]{12}(\.[^./]*)?$')
+
+_manifests = dict()
+
+
+def build(static_path):
+    """Build the assets under static_path, returns the manifest.
+    """
+    build_path = os.path.join(static_path, BUILD_DIRECTORY)
+    manifest = dict()
+    for directory, directory_names, file_names in os.walk(static_path):
+        if os.path.abspath(directory) == os.path.abspath(static_path):
+            directory_names[:] = [name for name in directory_names if name != BUILD_DIRECTORY]
+        for file_name in file_names:
+            source = os.path.join(directory, file_name)
+            path = os.path.relpath(source, static_path).replace(os.sep, '/')
+            with open(source, 'rb') as source_file:
+                contents = source_file.read()
+            name, extension = os.path.splitext(path)
+            built_path = '{0}.{1}{2}'.format(name, md5(contents).hexdigest()[:12], extension)
+            _write_variants(os.path.join(build_path, built_path), contents, mimetypes.guess_type(path)[0] or '')
+            manifest[path] = built_path
+    os.makedirs(build_path, exist_ok=True)
+    manifest_file_name = os.path.join(build_path, MANIFEST_NAME)
+    with open(manifest_file_name + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(manifest_file_name + '.tmp', manifest_file_name)
+    _manifests.pop(static_path, None)
+    logging.info('Built {0} static assets.'.format(len(manifest)))
+    return manifest
+
+
+def load_manifest(static_path):
+    """Returns the manifest written by build(), empty if not built.
+    """
+    if static_path not in _manifests:
+        try:
+            with open(os.path.join(static_path, BUILD_DIRECTORY, MANIFEST_NAME)) as manifest_file:
+                _manifests[static_path] = json.load(manifest_file)
+        except FileNotFoundError:
+            _manifests[static_path] = dict()
+    return _manifests[static_path]
+
+
+def _write_variants(file_name, contents, mime_type):
+    # Built names contain the content hash, an existing file is already complete.
+    if os.path.exists(file_name):
+        return
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    variants = [('', contents)]
+    if not mime_type.startswith(_COMPRESSED_TYPES):
+        variants.append(('.gz', gzip.compress(contents, compresslevel=9)))
+        try:
+            import brotli
+            variants.append(('.br', brotli.compress(contents)))
+        except ImportError:
+            pass
+    # The uncompressed file is written last, it marks the variants as complete.
+    for suffix, variant in reversed(variants):
+        if suffix and len(variant) >= len(contents):
+            continue
+        with open(file_name + suffix + '.tmp', 'wb') as variant_file:
+            variant_file.write(variant)
+        os.replace(file_name + suffix + '.tmp', file_name + suffix)
+
+
+class AssetHandler(tornado.web.StaticFileHandler):
+    """Serves the static directory, built assets with immutable cache headers and precompressed if accepted.
+    """
+    _encodings = (('br', '.br'), ('gzip', '.gz'))
+    encoding = None
+    # See core.logs.log_request().
+    access_log_sample_rate = 0.01
+
+    @classmethod
+    def make_static_url(cls, settings, path, include_version=True):
+        built_path = load_manifest(settings['static_path']).get(path)
+        if built_path:
+            return '{0}{1}/{2}'.format(settings.get('static_url_prefix', '/static/'), BUILD_DIRECTORY, built_path)
+        return super().make_static_url(settings, path, include_version)
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = super().validate_absolute_path(root, absolute_path)
+        self.encoding = None
+        if absolute_path is None or not self.is_built():
+            return absolute_path
+        accepted = _accepted_encodings(self.request.headers.get('Accept-Encoding', ''))
+        for encoding, suffix in self._encodings:
+            if encoding in accepted and os.path.isfile(absolute_path + suffix):
+                self.encoding = encoding
+                return absolute_path + suffix
+        return absolute_path
+
+    def get_content_type(self):
+        return mimetypes.guess_type(self.path)[0] or 'application/octet-stream'
+
+    def set_extra_headers(self, path):
+        if self.is_built():
+            self.set_header('Vary', 'Accept-Encoding')
+            # The manifest keeps its name across builds, it is revalidated like the unbuilt files.
+            if _FINGERPRINT_PATTERN.search(self.path):
+                self.set_header('Cache-Control', 'public, max-age=31536000, immutable')
+        if self.encoding:
+            self.set_header('Content-Encoding', self.encoding)
+
+    def is_built(self):
+        return self.path.startswith(BUILD_DIRECTORY + '/')
+
+
+def _accepted_encodings(header):
+    """Returns the content codings the Accept-Encoding header accepts, those with q=0 are refused.
+    """
+    qualities = dict()
+    for item in header.split(','):
+        coding, _, parameters = item.partition(';')
+        quality = 1.0
+        parameter, _, value = parameters.partition('=')
+        if parameter.strip().lower() == 'q':
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+        if coding.strip():
+            qualities[coding.strip().lower()] = quality
+    wildcard = qualities.pop('*', 0.0)
+    return {coding for coding, _ in AssetHandler._encodings
+            if qualities.get(coding, wildcard) > 0}
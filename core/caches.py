@@ -0,0 +1,143 @@
+from collections import OrderedDict
+import logging
+import time
+
+from tornado.options import options
+import redis
+
+
+_redis_session_db_pool = redis.ConnectionPool(host=options.redis_session_db_host,
+                                              port=options.redis_session_db_port,
+                                              db=options.redis_session_db_database,
+                                              decode_responses=True,
+                                              socket_timeout=options.redis_session_db_timeout)
+
+_redis_cache_db_pool = redis.ConnectionPool(host=options.redis_cache_db_host,
+                                            port=options.redis_cache_db_port,
+                                            db=options.redis_cache_db_database,
+                                            decode_responses=True,
+                                            socket_timeout=options.redis_cache_db_timeout)
+
+if options.redis_fake:
+    import fakeredis
+    _fake_session_db = fakeredis.FakeStrictRedis(db=options.redis_session_db_database, decode_responses=True)
+    _fake_cache_db = fakeredis.FakeStrictRedis(db=options.redis_cache_db_database, decode_responses=True)
+
+
+def session_database():
+    """Connect to the session database
+    """
+    if options.redis_fake:
+        return _fake_session_db
+    return redis.StrictRedis(connection_pool=_redis_session_db_pool)
+
+
+def cache_database():
+    """Connect to the cache database
+    """
+    if options.redis_fake:
+        return _fake_cache_db
+    return redis.StrictRedis(connection_pool=_redis_cache_db_pool)
+
+
+_SESSION_INDEX_KEY = 'sessions:{0}'
+
+
+def index_session(user_id, session_id, expire_time):
+    """Add the session to the user's session index, expired sessions are dropped from the index meanwhile.
+    """
+    key = _SESSION_INDEX_KEY.format(user_id)
+    pipeline = session_database().pipeline()
+    pipeline.zadd(key, expire_time, session_id)
+    pipeline.zremrangebyscore(key, '-inf', time.time())
+    pipeline.expire(key, options.session_expire_after)
+    pipeline.execute()
+
+
+def unindex_session(user_id, session_id):
+    """Remove the session from the user's session index.
+    """
+    session_database().zrem(_SESSION_INDEX_KEY.format(user_id), session_id)
+
+
+def revoke_sessions(user_ids):
+    """Delete every session of the users found by their session indexes, returns the number of sessions.
+    """
+    keys = [_SESSION_INDEX_KEY.format(user_id) for user_id in user_ids]
+    if not keys:
+        return 0
+    redis_client = session_database()
+    pipeline = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipeline.zrange(key, 0, -1)
+    session_ids = [session_id for session_ids in pipeline.execute() for session_id in session_ids]
+    redis_client.delete(*(session_ids + keys))
+    return len(session_ids)
+
+
+class LRUCache(object):
+    """In-process cache holding at most max_size entries, evicts the least recently used one.
+
+    Entries expire expire_after seconds after they are set, if given.
+    """
+    def __init__(self, max_size, expire_after=None):
+        self.max_size = max_size
+        self.expire_after = expire_after
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """Get cached value.
+        """
+        if key not in self._entries:
+            return default
+        value, expire_time = self._entries[key]
+        if expire_time is not None and expire_time <= time.time():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        """Set cache value.
+        """
+        self._entries[key] = (value, time.time() + self.expire_after if self.expire_after else None)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+def get_version(key):
+    """Returns current version of the data named by the key, None if the cache database is unavailable.
+
+    Versions can not be trusted without the cache database, callers should skip caches keyed by the version then.
+    """
+    try:
+        redis_client = cache_database()
+        version = redis_client.get(key)
+        if version is None:
+            version = _seed_version(redis_client, key)[1]
+        return int(version)
+    except:
+        logging.warning('Failed to get version of {0}.'.format(key))
+        return None
+
+
+def bump_version(key):
+    """Increase version of the data named by the key, so that caches keyed by the old version are skipped.
+    """
+    try:
+        _seed_version(cache_database(), key, incr=True)
+    except:
+        logging.warning('Failed to bump version of {0}.'.format(key))
+
+
+def _seed_version(redis_client, key, incr=False):
+    # A version lost with the cache database, e.g. after a restart or an eviction, starts again from the current time
+    # in microseconds rather than 0, so it never repeats a version that workers and browsers may still have cached.
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.set(key, int(time.time() * 1000000), nx=True)
+    if incr:
+        pipeline.incr(key)
+    else:
+        pipeline.get(key)
+    return pipeline.execute()
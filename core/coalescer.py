@@ -0,0 +1,51 @@
+"""Group commit of writes arriving within a few milliseconds of each other.
+
+submit() queues an operation under a key, e.g. the database session it writes to, and returns a Future. The
+operations queued under a key are flushed together max_delay seconds after the first of them arrived, or at once when
+max_batch are queued, so a write waits at most max_delay longer than it would alone while one commit, and one fsync,
+serves the whole batch. flush(key, operations) runs on the IOLoop and returns one result per operation, an Exception
+result fails the Future of that operation only.
+"""
+import logging
+
+from tornado.concurrent import Future
+import tornado.ioloop
+
+
+class Coalescer(object):
+    def __init__(self, flush, max_delay, max_batch):
+        self.flush = flush
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self._batches = dict()
+        self._timeouts = dict()
+
+    def submit(self, key, operation):
+        """Queue the operation, returns a Future resolved with its result once its batch is flushed.
+        """
+        future = Future()
+        batch = self._batches.setdefault(key, [])
+        batch.append((operation, future))
+        if len(batch) >= self.max_batch:
+            self._flush(key)
+        elif len(batch) == 1:
+            self._timeouts[key] = tornado.ioloop.IOLoop.current().call_later(self.max_delay, self._flush, key)
+        return future
+
+    def _flush(self, key):
+        timeout = self._timeouts.pop(key, None)
+        if timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(timeout)
+        batch = self._batches.pop(key, [])
+        if not batch:
+            return
+        try:
+            results = self.flush(key, [operation for operation, _ in batch])
+        except Exception as e:
+            logging.exception('Failed to flush {0} operations.'.format(len(batch)))
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
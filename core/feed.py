@@ -0,0 +1,152 @@
+"""Change feed on a Redis stream, written through the outbox table so that events survive Redis failures.
+
+A change adds its event with record() before committing and calls publish() after committing. Events publish()
+fails to send stay in the outbox and are sent by the relay every worker runs, see install(). Delivery is at least
+once, consumers should skip event IDs they have seen.
+"""
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+
+from tornado.options import options
+import tornado.ioloop
+
+from core.caches import cache_database
+from core.models import Outbox, fan_out
+
+
+STREAM_KEY = 'feed:customers'
+_RELAY_LOCK_KEY = 'feed:relay'
+
+
+def record(db, event):
+    """Add the event to the outbox in the current database transaction, returns what to publish after committing.
+    """
+    if not options.feed_enabled:
+        return None
+    now = datetime.now()
+    outbox = Outbox(payload='', createTime=now)
+    db.add(outbox)
+    db.flush()
+    # The outbox ID is unique in a shard and the time tells shards apart, consumers deduplicate on both.
+    outbox.payload = json.dumps(dict(event, id=outbox.id, time=now.timestamp()), separators=(',', ':'))
+    return outbox.id, outbox.payload
+
+
+def publish(db, *events):
+    """Send committed events to the stream and delete them from the outbox, the relay retries failures.
+    """
+    events = [e for e in events if e]
+    if not events:
+        return
+    try:
+        _send([payload for _, payload in events])
+    except:
+        logging.warning('Failed to publish events {0}, left to the relay.'.format([id for id, _ in events]))
+        return
+    db.query(Outbox).filter(Outbox.id.in_([id for id, _ in events])).delete(synchronize_session=False)
+    db.commit()
+
+
+def install():
+    """Start relaying events left in the outbox, call it in each worker after forking.
+    """
+    if options.feed_enabled:
+        tornado.ioloop.PeriodicCallback(relay, options.feed_relay_interval * 1000).start()
+
+
+def relay():
+    """Send events older than feed_relay_delay from the outbox of every shard, one worker at a time.
+    """
+    redis_client = cache_database()
+    try:
+        if not redis_client.set(_RELAY_LOCK_KEY, os.getpid(), nx=True, ex=max(int(options.feed_relay_interval), 1)):
+            return
+    except:
+        return
+    before = datetime.now() - timedelta(seconds=options.feed_relay_delay)
+
+    def relay_shard(db):
+        rows = db.query(Outbox.id, Outbox.payload).filter(Outbox.createTime < before)\
+                 .order_by(Outbox.id).limit(options.feed_relay_batch_size).all()
+        if rows:
+            _send([row.payload for row in rows])
+            db.query(Outbox).filter(Outbox.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+            db.commit()
+        return len(rows)
+
+    try:
+        relayed = sum(fan_out(relay_shard))
+        if relayed:
+            logging.info('Relayed {0} events from the outbox.'.format(relayed))
+    except:
+        logging.warning('Failed to relay events from the outbox.')
+
+
+def _send(payloads):
+    # redis-py 2.10 predates streams, XADD requires Redis 5.
+    pipeline = cache_database().pipeline(transaction=False)
+    for payload in payloads:
+        pipeline.execute_command('XADD', STREAM_KEY, 'MAXLEN', '~', options.feed_max_length, '*', 'event', payload)
+    pipeline.execute()
+
+
+class FeedConsumer(object):
+    """Member of a consumer group reading the feed, the group's last delivered and acknowledged IDs are the checkpoint.
+
+    Events a consumer read but did not acknowledge before stopping are delivered to it again when it restarts under
+    the same name.
+    """
+    def __init__(self, group, name, redis_client=None):
+        self.group = group
+        self.name = name
+        self.redis_client = redis_client or cache_database()
+        self._pending = True
+
+    def create_group(self, start='0'):
+        """Create the group if missing, start is the stream ID to deliver after, '$' for new events only.
+        """
+        try:
+            self.redis_client.execute_command('XGROUP', 'CREATE', STREAM_KEY, self.group, start, 'MKSTREAM')
+        except Exception as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def read(self, count=100, block=5000):
+        """Returns up to count (stream ID, event) pairs, the unacknowledged ones of this consumer first.
+        """
+        reply = self.redis_client.execute_command('XREADGROUP', 'GROUP', self.group, self.name, 'COUNT', count,
+                                                  'BLOCK', block, 'STREAMS', STREAM_KEY,
+                                                  '0' if self._pending else '>')
+        entries = reply[0][1] if reply else []
+        # Entries trimmed from the stream while pending come back without fields.
+        self.ack([id for id, fields in entries if not fields])
+        if self._pending and not entries:
+            self._pending = False
+            return self.read(count, block)
+        return [(id, json.loads(dict(zip(fields[::2], fields[1::2]))['event'])) for id, fields in entries if fields]
+
+    def ack(self, ids):
+        """Acknowledge processed events, they are not delivered to the group again.
+        """
+        if ids:
+            self.redis_client.execute_command('XACK', STREAM_KEY, self.group, *ids)
+
+    def run(self, handle, count=100, block=5000):
+        """Call handle(event) for each event forever, acknowledging each batch after handling it.
+        """
+        self.create_group()
+        while True:
+            entries = self.read(count, block)
+            for _, event in entries:
+                handle(event)
+            self.ack([id for id, _ in entries])
+
+
+def set_group_position(group, since):
+    """Make the group deliver again the events published since the given datetime, returns the stream ID.
+    """
+    stream_id = '{0}-0'.format(int(since.timestamp() * 1000))
+    cache_database().execute_command('XGROUP', 'SETID', STREAM_KEY, group, stream_id)
+    return stream_id
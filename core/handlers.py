@@ -1,3 +1,6 @@
+from calendar import timegm
+from datetime import datetime
+from email.utils import parsedate
 import json
 import re
 from hashlib import md5
@@ -7,44 +10,89 @@ import logging
 
 from tornado.options import options
 import tornado.web
-import redis
-
-from core.models import read_write_database
+import tornado.websocket
+
+from core.caches import session_database, cache_database, index_session, unindex_session, LRUCache
+from core.limiter import consume_token, request_started, request_finished, is_overloaded
+from core.logs import under_pressure
+from core.models import read_write_database, seller_database, SellerMovingError
+from core.utils.profiler import PROFILE_HEADER, start_request_profile, finish_request_profile
+from core.workers import on_request_finished
 from urvip.models import Admin
 
 
-_int_pattern, _float_pattern = re.compile('^-?[0-9]+$'), re.compile('^-?[0-9]+(\.[0-9]+)?$')
+_fragment_cache = LRUCache(options.fragment_cache_size, options.fragment_cache_expire_after)
 
-_redis_session_db_pool = redis.ConnectionPool(host=options.redis_session_db_host,
-                                              port=options.redis_session_db_port,
-                                              db=options.redis_session_db_database,
-                                              decode_responses=True,
-                                              socket_timeout=options.redis_session_db_timeout)
+_int_pattern, _float_pattern = re.compile('^-?[0-9]+$'), re.compile('^-?[0-9]+(\.[0-9]+)?$')
 
-_redis_cache_db_pool = redis.ConnectionPool(host=options.redis_cache_db_host,
-                                            port=options.redis_cache_db_port,
-                                            db=options.redis_cache_db_database,
-                                            decode_responses=True,
-                                            socket_timeout=options.redis_cache_db_timeout)
+# Part of every ETag, so that pages cached by clients are refreshed after templates are changed and deployed.
+_etag_salt = str(time.time())
 
 
 class BaseHandler(tornado.web.RequestHandler):
     """Base class for page handlers and API handlers.
     """
+    # Token buckets as (scope, rate per second, burst), scope is 'route', 'ip' or 'seller'.
+    rate_limits = ()
+    # Fraction of successful requests written to the access log, see core.logs.log_request().
+    access_log_sample_rate = 1
+
     def initialize(self):
         # Ensure that we are getting the real IP.
         if 'X-Real-Ip' in self.request.headers:
             self.request.remote_ip = self.request.headers['X-Real-Ip']
 
     def prepare(self):
-        """Prepare database connection.
+        """Prepare database connection, reject the request if throttled.
         """
         self.db = read_write_database()
+        self._seller_db = None
+        self.profile_token = self.request.headers.get(PROFILE_HEADER)
+        self.profile = start_request_profile(self.profile_token) if self.profile_token else None
+        request_started()
+        self.throttle()
 
     def on_finish(self):
         """Close database connection.
         """
+        if self.profile:
+            finish_request_profile(self.profile, self.profile_token)
         self.db.close()
+        if self._seller_db is not None and self._seller_db is not self.db:
+            self._seller_db.close()
+        request_finished()
+        on_request_finished()
+
+    @property
+    def seller_db(self):
+        """Connect to the shard holding the current seller's charge rules, customers and transactions.
+        """
+        if self._seller_db is None:
+            try:
+                self._seller_db = seller_database(self.current_user.sellerId)
+            except SellerMovingError:
+                raise tornado.web.HTTPError(503, reason='Service Unavailable')
+        return self._seller_db
+
+    def throttle(self):
+        """Reject the request cheaply if the worker is overloaded or a rate limit is exceeded.
+        """
+        if is_overloaded():
+            logging.warning('Shed request to {0}. ({1})'.format(self.request.path, self.request.remote_ip))
+            raise tornado.web.HTTPError(503, reason='Service Unavailable')
+        now = time.time()
+        for scope, rate, burst in self.rate_limits:
+            if scope == 'route':
+                key = 'route:{0}'.format(type(self).__name__)
+            elif scope == 'ip':
+                key = 'ip:{0}:{1}'.format(type(self).__name__, self.request.remote_ip)
+            elif scope == 'seller' and self.current_user:
+                key = 'seller:{0}:{1}'.format(type(self).__name__, self.current_user.sellerId)
+            else:
+                continue
+            if not consume_token(key, rate, burst, now):
+                logging.warning('Rate limit {0} exceeded. ({1})'.format(key, self.request.remote_ip))
+                raise tornado.web.HTTPError(429, reason='Too Many Requests')
 
     def get_str_argument(self, name, default='', strip=True):
         """Returns str value of the argument.
@@ -77,7 +125,7 @@ class BaseHandler(tornado.web.RequestHandler):
         session_data['userId'] = user_id
         session_data_str = json.dumps(session_data)
         timestamp = hex(int(time.time()))[2:]
-        redis_client = redis.StrictRedis(connection_pool=_redis_session_db_pool)
+        redis_client = session_database()
         for retry_times in range(3):
             if retry_times > 0:
                 logging.warning('Generated duplicate session ID, will try a new one.')
@@ -90,7 +138,14 @@ class BaseHandler(tornado.web.RequestHandler):
             if redis_client.set(session_id, session_data_str, ex=options.session_expire_after, nx=True):
                 break
         if redis_client.get(session_id) == session_data_str:
-            return session_id, time.time() + options.session_expire_after
+            expire_time = time.time() + options.session_expire_after
+            # The session is stored already, failing the login now would only leave it behind. Without the index
+            # revoke_sessions() misses it, it lasts until it expires.
+            try:
+                index_session(user_id, session_id, expire_time)
+            except:
+                logging.warning('Failed to index session of user {0}.'.format(user_id))
+            return session_id, expire_time
         else:
             return None, 0
 
@@ -100,7 +155,7 @@ class BaseHandler(tornado.web.RequestHandler):
         if not self.session_id:
             return None
         try:
-            redis_client = redis.StrictRedis(connection_pool=_redis_session_db_pool)
+            redis_client = session_database()
             session_data = redis_client.get(self.session_id)
             return json.loads(session_data) if session_data else None
         except:
@@ -112,7 +167,7 @@ class BaseHandler(tornado.web.RequestHandler):
         if not self.session_id:
             return False
         session_data_str = json.dumps(session_data)
-        redis_client = redis.StrictRedis(connection_pool=_redis_session_db_pool)
+        redis_client = session_database()
         return redis_client.set(self.session_id, session_data_str, ex=options.session_expire_after, xx=True)
 
     def invalidate_session(self):
@@ -120,8 +175,14 @@ class BaseHandler(tornado.web.RequestHandler):
         """
         if not self.session_id:
             return
-        redis_client = redis.StrictRedis(connection_pool=_redis_session_db_pool)
+        session = self.get_session()
+        redis_client = session_database()
         redis_client.delete(self.session_id)
+        if session:
+            try:
+                unindex_session(session['userId'], self.session_id)
+            except:
+                logging.warning('Failed to unindex session of user {0}.'.format(session['userId']))
 
     def get_current_user(self):
         """Returns a fake user.
@@ -144,15 +205,39 @@ class BaseHandler(tornado.web.RequestHandler):
     def get_cache(self, key):
         """Get cached value.
         """
-        redis_client = redis.StrictRedis(connection_pool=_redis_cache_db_pool)
+        redis_client = cache_database()
         return redis_client.get(key)
 
     def set_cache(self, key, value, ex=None):
         """Set cache value.
         """
-        redis_client = redis.StrictRedis(connection_pool=_redis_cache_db_pool)
+        redis_client = cache_database()
         return redis_client.set(key, value, ex=ex)
 
+    def get_fragment(self, key, render):
+        """Get rendered fragment from the in-process LRU or the cache database, call render() on cache miss.
+
+        The key should contain the version of the data, fragments are never invalidated otherwise. A key of None
+        renders without caching, e.g. when the version is unknown.
+        """
+        if key is None:
+            return render()
+        fragment = _fragment_cache.get(key)
+        if fragment is not None:
+            return fragment
+        try:
+            fragment = self.get_cache(key)
+        except:
+            logging.warning('Failed to get fragment {0}.'.format(key))
+        if fragment is None:
+            fragment = render()
+            try:
+                self.set_cache(key, fragment, ex=options.fragment_cache_expire_after)
+            except:
+                logging.warning('Failed to set fragment {0}.'.format(key))
+        _fragment_cache.set(key, fragment)
+        return fragment
+
 
 class PageHandler(BaseHandler):
     """Base class for handlers rendering web pages.
@@ -164,6 +249,36 @@ class PageHandler(BaseHandler):
     def on_login_required(self):
         self.redirect('/login')
 
+    def check_not_modified(self, validator, last_modified=None):
+        """Set validators of the page, returns True after responding 304 if the client's copy is still fresh.
+
+        The validator should change whenever the page changes, e.g. contain the update time or the data version. A
+        validator of None sets no validators, e.g. when the data version is unknown. last_modified is in local time.
+        """
+        if validator is None:
+            return False
+        etag = md5('{0}:{1}:{2}'.format(_etag_salt, self.current_user.id, validator).encode('utf-8')).hexdigest()
+        self.set_header('Etag', '"{0}"'.format(etag))
+        self.set_header('Cache-Control', 'private, no-cache')
+        if last_modified and time.time() - last_modified.timestamp() < 1:
+            # Last-Modified has whole seconds only, a later change in the same second would be taken as unmodified.
+            # Once the second is over, any later change falls in a later second.
+            last_modified = None
+        if last_modified:
+            # Tornado formats naive datetimes as UTC.
+            last_modified = datetime.utcfromtimestamp(last_modified.timestamp())
+            self.set_header('Last-Modified', last_modified)
+        if 'If-None-Match' in self.request.headers:
+            fresh = self.check_etag_header()
+        else:
+            modified_since = parsedate(self.request.headers.get('If-Modified-Since', ''))
+            fresh = bool(last_modified and modified_since and
+                         timegm(modified_since) >= timegm(last_modified.utctimetuple()))
+        if fresh:
+            self.set_status(304)
+            self.finish()
+        return fresh
+
 
 class ApiHandler(BaseHandler):
     def api_succeed(self, data=None):
@@ -183,9 +298,9 @@ class ApiHandler(BaseHandler):
         if data:
             result['data'] = data
         result_bytes = json.dumps(result).encode('utf-8')
-        if options.debug and len(result_bytes) < 10000:
-            logging.info(result)
-        logging.info('Returned {0} bytes.'.format(len(result_bytes)))
+        if options.debug and len(result_bytes) < 10000 and random() < options.log_payload_sample_rate and \
+                not under_pressure():
+            logging.info('Returned {0} bytes: {1}'.format(len(result_bytes), result))
         self.finish(result_bytes)
 
     @property
@@ -206,6 +321,11 @@ class ApiHandler(BaseHandler):
         elif status_code == 405:
             self.api_failed(4, 'Forbidden.')
             logging.warning('Invalid request method. ({0})'.format(self.request.remote_ip))
+        elif status_code == 409:
+            # Optimistic update conflicts are expected, clients reload the data and retry.
+            self.api_failed(8, 'Conflict.')
+        elif status_code in {429, 503}:
+            self.api_failed(6, 'Too busy.')
         elif status_code == 500:
             self.api_failed(5, 'Internal error.')
             logging.warning('Internal error. ({0})'.format(self.request.remote_ip))
@@ -214,6 +334,23 @@ class ApiHandler(BaseHandler):
             logging.warning('HTTP error {0}. ({1})'.format(status_code, self.request.remote_ip))
 
 
+class SocketHandler(tornado.websocket.WebSocketHandler):
+    """Base class for WebSocket handlers, authenticated by the session cookie of the pages.
+
+    The handshake is rejected unless the Origin header matches the host, so other sites cannot use the cookie.
+    """
+    get_session = BaseHandler.get_session
+    get_current_user = BaseHandler.get_current_user
+
+    @property
+    def session_id(self):
+        return self.get_secure_cookie('sessionId')
+
+    def on_login_required(self):
+        self.set_status(401)
+        self.finish()
+
+
 class InvalidUrlHandler(BaseHandler):
     """Handles invalid URLs.
     """
@@ -0,0 +1,89 @@
+import logging
+
+from tornado.options import options
+import tornado.ioloop
+
+from core.caches import cache_database
+
+
+# Token bucket refilled at rate tokens per second and holding at most burst tokens.
+_consume_token_script = '''
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(bucket[1]) or burst
+local time = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - time) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'time', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+'''
+
+_consume_token = None
+_in_flight_requests = 0
+# How late the last probe ran, i.e. how long callbacks and requests currently wait for the IOLoop.
+_loop_delay = 0.0
+_PROBE_INTERVAL = 0.1
+
+
+def consume_token(key, rate, burst, now):
+    """Take a token from the bucket in the cache database, returns False if the bucket is empty.
+
+    Fails open, requests are not rejected because the cache database is unavailable.
+    """
+    global _consume_token
+    try:
+        if _consume_token is None:
+            _consume_token = cache_database().register_script(_consume_token_script)
+        return bool(_consume_token(keys=['rateLimit:{0}'.format(key)], args=[rate, burst, now]))
+    except:
+        logging.warning('Failed to check rate limit {0}.'.format(key))
+        return True
+
+
+def request_started():
+    """Count a request in flight in this worker.
+    """
+    global _in_flight_requests
+    _in_flight_requests += 1
+
+
+def request_finished():
+    """Count a request out of flight in this worker.
+    """
+    global _in_flight_requests
+    _in_flight_requests -= 1
+
+
+def install():
+    """Start measuring the IOLoop's delay, call it in each worker after forking.
+    """
+    _schedule_probe(tornado.ioloop.IOLoop.current())
+
+
+def is_overloaded():
+    """Returns True if the worker has too many requests in flight, or requests wait too long for the IOLoop.
+
+    Requests are handled on the IOLoop, so work queued ahead of a request delays it. The delay is measured by a
+    timer rather than from the start of the request, which would include the time spent uploading its body.
+    """
+    if options.max_in_flight_requests and _in_flight_requests > options.max_in_flight_requests:
+        return True
+    if options.max_queue_delay and _loop_delay > options.max_queue_delay:
+        return True
+    return False
+
+
+def _schedule_probe(io_loop):
+    io_loop.call_later(_PROBE_INTERVAL, _probe, io_loop, io_loop.time() + _PROBE_INTERVAL)
+
+
+def _probe(io_loop, expected_time):
+    # Timers run before the IOLoop polls sockets, requests read after a stall see the delay it caused.
+    global _loop_delay
+    _loop_delay = max(io_loop.time() - expected_time, 0.0)
+    _schedule_probe(io_loop)
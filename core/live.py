@@ -0,0 +1,74 @@
+"""Push messages to open WebSockets of every worker through Redis pub/sub.
+
+Each worker runs one listener thread, started by the first subscriber, which receives the messages of all channels
+and hands them to the IOLoop. Messages published while a worker is reconnecting are lost, pages should reload when
+their WebSocket reconnects.
+"""
+from threading import Thread
+import json
+import logging
+import time
+
+import tornado.ioloop
+
+from core.caches import cache_database
+
+
+_CHANNEL_KEY = 'live:{0}'
+
+_subscribers = dict()
+_listener = None
+
+
+def publish(channel, message):
+    """Send the message to the subscribers of the channel in every worker.
+    """
+    try:
+        cache_database().publish(_CHANNEL_KEY.format(channel), json.dumps(message, separators=(',', ':')))
+    except:
+        logging.warning('Failed to publish to {0}.'.format(channel))
+
+
+def subscribe(channel, callback):
+    """Call callback(message) with the JSON string of each message published to the channel.
+    """
+    global _listener
+    if _listener is None:
+        _listener = Thread(target=_listen, args=(tornado.ioloop.IOLoop.current(),), daemon=True)
+        _listener.start()
+    _subscribers.setdefault(channel, set()).add(callback)
+
+
+def unsubscribe(channel, callback):
+    """Stop calling the callback.
+    """
+    callbacks = _subscribers.get(channel)
+    if callbacks is not None:
+        callbacks.discard(callback)
+        if not callbacks:
+            del _subscribers[channel]
+
+
+def _listen(io_loop):
+    prefix = _CHANNEL_KEY.format('')
+    while True:
+        try:
+            pubsub = cache_database().pubsub(ignore_subscribe_messages=True)
+            pubsub.psubscribe(_CHANNEL_KEY.format('*'))
+            while True:
+                message = pubsub.get_message(timeout=1)
+                if message is None:
+                    time.sleep(0.01)
+                elif message['type'] == 'pmessage':
+                    io_loop.add_callback(_dispatch, message['channel'][len(prefix):], message['data'])
+        except:
+            logging.warning('Lost the live channels, will reconnect.')
+            time.sleep(1)
+
+
+def _dispatch(channel, message):
+    for callback in list(_subscribers.get(channel, ())):
+        try:
+            callback(message)
+        except:
+            logging.exception('Failed to push to a subscriber of {0}.'.format(channel))
@@ -0,0 +1,80 @@
+"""Logging that never blocks the IOLoop on disk.
+
+install() moves the handlers configured by tornado.options, e.g. the rotating file of --log_file_prefix, behind a
+bounded in-memory queue written by a background thread. Records that do not fit in the queue are dropped and
+counted, the counts are logged once the queue drains. log_request() writes one JSON access record per request,
+sampled by the access_log_sample_rate of each handler. Errors and slow requests are always recorded.
+"""
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue, Full
+from random import random
+import atexit
+import json
+import logging
+
+from tornado.options import options
+import tornado.ioloop
+
+
+_access_log = logging.getLogger('tornado.access')
+_queue = None
+_dropped = Counter()
+_skipped = Counter()
+
+
+class _DroppingQueueHandler(QueueHandler):
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            _dropped[record.levelname] += 1
+
+
+def install():
+    """Log through the queue, call it in each worker after forking.
+    """
+    global _queue
+    _queue = Queue(options.log_queue_size)
+    root = logging.getLogger()
+    listener = QueueListener(_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [_DroppingQueueHandler(_queue)]
+    listener.start()
+    atexit.register(listener.stop)
+    tornado.ioloop.PeriodicCallback(_report, options.log_report_interval * 1000).start()
+
+
+def under_pressure():
+    """Returns True if the queue is more than half full, optional records should be skipped.
+    """
+    return _queue is not None and _queue.qsize() > _queue.maxsize / 2
+
+
+def log_request(handler):
+    """Write the access record of the request, used as the log_function of the application.
+    """
+    status = handler.get_status()
+    request_time = handler.request.request_time()
+    sample_rate = getattr(handler, 'access_log_sample_rate', 1)
+    if status < 400 and request_time < options.log_slow_request_time and \
+            (under_pressure() or random() >= sample_rate):
+        _skipped[type(handler).__name__] += 1
+        return
+    if status < 400:
+        method = _access_log.info
+    elif status < 500:
+        method = _access_log.warning
+    else:
+        method = _access_log.error
+    method(json.dumps({'method': handler.request.method, 'path': handler.request.path, 'status': status,
+                       'ms': round(request_time * 1000, 2), 'ip': handler.request.remote_ip,
+                       'handler': type(handler).__name__, 'sampleRate': sample_rate}, sort_keys=True))
+
+
+def _report():
+    if _skipped and not under_pressure():
+        _access_log.info(json.dumps({'skipped': dict(_skipped)}, sort_keys=True))
+        _skipped.clear()
+    if _dropped and not under_pressure():
+        logging.warning('Dropped log records: {0}.'.format(dict(_dropped)))
+        _dropped.clear()
@@ -1,17 +1,83 @@
+from concurrent.futures import ThreadPoolExecutor
 import math
+import time
 
 from tornado.options import options
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, Column, BigInteger, Integer, Text, DateTime, or_
+from sqlalchemy.dialects import mysql
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
 
-_engine = create_engine('mysql+pymysql://{3}:{4}@{0}:{1}/{2}?charset=utf8mb4'
-                        .format(options.mysql_host, options.mysql_port, options.mysql_database,
-                                options.mysql_user, options.mysql_password),
-                        echo=options.debug)
-_read_write_database = sessionmaker(bind=_engine)()
+_engine = None
+_read_write_database = None
+_shard_engines = []
+_shard_databases = []
+_seller_shards = dict()
 BaseModel = declarative_base()
+# SQLite only auto-increments INTEGER primary keys.
+IdType = BigInteger().with_variant(Integer, 'sqlite')
+# MySQL DATETIME rounds to seconds, update times sent back by pages for optimistic checks must keep microseconds.
+TimeType = DateTime().with_variant(mysql.DATETIME(fsp=6), 'mysql')
+# Shard of sellers whose data stays in the master database, e.g. those added before sharding was configured.
+MASTER_SHARD = -1
+
+
+class SellerMovingError(Exception):
+    """The seller is being moved to another shard, its data must not be touched.
+    """
+    pass
+
+
+class UpdateConflictError(Exception):
+    """The row was changed or deleted after the client read it, the update time sent back no longer matches.
+    """
+    pass
+
+
+class SellerShard(BaseModel):
+    """Directory of the shard holding each seller's charge rules, customers and transactions, in the master database
+    """
+    __tablename__ = 'seller_shard'
+    sellerId = Column('seller_id', IdType, primary_key=True, autoincrement=False)
+    shard = Column('shard', Integer)
+    # 1 normal, 5 moving
+    status = Column('status', Integer)
+
+
+class Outbox(BaseModel):
+    """Feed events committed with the changes they describe, deleted once published, see core.feed
+    """
+    __tablename__ = 'outbox'
+    id = Column('id', IdType, primary_key=True)
+    payload = Column('payload', Text)
+    createTime = Column('create_time', DateTime, index=True)
+
+
+def init():
+    """Create the engines and the sessions, call it in each worker after forking
+    """
+    global _engine, _read_write_database, _shard_engines, _shard_databases
+    _engine = create_engine(database_url(), echo=options.debug)
+    _read_write_database = sessionmaker(bind=_engine)()
+    _shard_engines = [create_engine(url, echo=options.debug) for url in options.shard_database_urls if url]
+    _shard_databases = [sessionmaker(bind=engine)() for engine in _shard_engines]
+
+
+def database_url():
+    """URL of the master database
+    """
+    if options.database_url:
+        return options.database_url
+    return 'mysql+pymysql://{3}:{4}@{0}:{1}/{2}?charset=utf8mb4'.format(options.mysql_host, options.mysql_port,
+                                                                        options.mysql_database, options.mysql_user,
+                                                                        options.mysql_password)
+
+
+def engine():
+    """Returns the engine created by init()
+    """
+    return _engine
 
 
 def read_write_database():
@@ -20,6 +86,106 @@ def read_write_database():
     return _read_write_database
 
 
+def shard_count():
+    """Number of shards, 0 if the master database holds every seller's data
+    """
+    return len(_shard_databases)
+
+
+def shards():
+    """Shards holding sellers' data, MASTER_SHARD included, as sellers remain in the master database until moved
+    """
+    return [MASTER_SHARD] + list(range(len(_shard_databases)))
+
+
+def shard_engine(shard):
+    """Returns the engine of the shard, or the master engine if not sharded or the shard is MASTER_SHARD
+    """
+    return _shard_engines[shard] if _shard_databases and shard != MASTER_SHARD else _engine
+
+
+def shard_database(shard):
+    """Connect to the shard, or the master database if not sharded or the shard is MASTER_SHARD
+    """
+    return _shard_databases[shard] if _shard_databases and shard != MASTER_SHARD else _read_write_database
+
+
+def seller_database(seller_id):
+    """Connect to the database holding the seller's charge rules, customers and transactions
+    """
+    if not _shard_databases:
+        return _read_write_database
+    return shard_database(seller_shard(seller_id))
+
+
+def seller_shard(seller_id):
+    """Look up the seller's shard in the directory, cached for shard_directory_cache_ttl seconds
+
+    Sellers missing from the directory were added before sharding, their data is in the master database until
+    move_seller.py moves them.
+    """
+    now = time.time()
+    entry = _seller_shards.get(seller_id)
+    if entry is None or entry[2] < now:
+        row = _read_write_database.query(SellerShard.shard, SellerShard.status)\
+                                  .filter(SellerShard.sellerId == seller_id).first()
+        shard, status = (row.shard, row.status) if row else (MASTER_SHARD, 1)
+        entry = _seller_shards[seller_id] = (shard, status, now + options.shard_directory_cache_ttl)
+    if entry[1] != 1:
+        raise SellerMovingError
+    return entry[0]
+
+
+def place_seller(seller_id):
+    """Shard of a seller not in the directory, jump consistent hash moves few sellers when shards are added
+    """
+    key, bucket, candidate = seller_id, -1, 0
+    while candidate < len(_shard_databases):
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        candidate = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def set_seller_shard(seller_id, shard, status=1):
+    """Save the seller's shard in the directory
+    """
+    _read_write_database.merge(SellerShard(sellerId=seller_id, shard=shard, status=status))
+    _read_write_database.commit()
+    _seller_shards.pop(seller_id, None)
+
+
+def fan_out(call):
+    """Call call(db) on every shard in parallel, each with its own session, returns the results in shards() order
+    """
+    engines = [shard_engine(shard) for shard in shards()]
+
+    def call_shard(engine):
+        db = sessionmaker(bind=engine)()
+        try:
+            return call(db)
+        finally:
+            db.close()
+
+    with ThreadPoolExecutor(max_workers=len(engines)) as executor:
+        return list(executor.map(call_shard, engines))
+
+
+def projection(model, row_class):
+    """Columns of the model named by the fields of the row class
+    """
+    return [getattr(model, field) for field in row_class._fields]
+
+
+def seek(query, time_column, id_column, after_time, after_id):
+    """Rows after (after_time, after_id) ordered by time and ID, so that a batch can continue where the last one ended
+
+    An index on the time column serves the range and the order, InnoDB and SQLite indexes end with the primary key.
+    """
+    return query.filter(time_column >= after_time, or_(time_column > after_time, id_column > after_id))\
+                .order_by(time_column, id_column)
+
+
 def paginate(total_count, page_num, page_size):
     """Calculate page number and page count
     """
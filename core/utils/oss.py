@@ -1,25 +1,56 @@
 from datetime import datetime
 from uuid import uuid4
+import os
 
 from tornado.options import options
-from oss2 import Auth, Bucket
 
 
-__auth = Auth(options.oss_access_key_id, options.oss_access_key_secret)
-__bucket = Bucket(__auth, 'http://{0}'.format(options.oss_endpoint), options.oss_bucket_name)
+__bucket = None
 
 
 def upload_oss(contents, extension, image=False, cache=False):
+    bucket = _get_bucket()
     for i in range(3):
         if cache:
             name = 'cache/{0}'.format(extension)
         else:
             name = '{0}.{1}'.format(str(uuid4()).replace('-', '')[:-len(extension) - 1], extension)
             name = '{0}/{1}'.format(datetime.now().year, name)
-        if __bucket.object_exists(name):
+        if bucket.object_exists(name):
             continue
-        __bucket.put_object(name, contents)
+        bucket.put_object(name, contents)
+        if options.oss_local_path:
+            return 'file://{0}'.format(os.path.abspath(os.path.join(options.oss_local_path, name)))
         return 'http://{0}.{1}/{2}'.format(options.oss_bucket_name,
                                            options.oss_img_endpoint if image else options.oss_endpoint,
                                            name)
     raise Exception('Failed to upload to OSS due to duplicate object name.')
+
+
+def _get_bucket():
+    """Import oss2 and create the bucket on first use, so that workers start without it.
+    """
+    global __bucket
+    if __bucket is None and options.oss_local_path:
+        __bucket = _LocalBucket(options.oss_local_path)
+    elif __bucket is None:
+        from oss2 import Auth, Bucket
+        __bucket = Bucket(Auth(options.oss_access_key_id, options.oss_access_key_secret),
+                          'http://{0}'.format(options.oss_endpoint), options.oss_bucket_name)
+    return __bucket
+
+
+class _LocalBucket(object):
+    """Stores objects in a local directory, stands in for the OSS bucket in benchmarks.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def object_exists(self, name):
+        return os.path.exists(os.path.join(self.path, name))
+
+    def put_object(self, name, contents):
+        path = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as object_file:
+            object_file.write(contents)
@@ -0,0 +1,181 @@
+from collections import Counter
+from threading import Thread, Event, main_thread
+from uuid import uuid4
+import cProfile
+import json
+import os
+import pstats
+import sys
+import time
+import logging
+
+from tornado.options import options
+import tornado.ioloop
+
+from core.caches import cache_database
+
+
+PROFILE_HEADER = 'X-Profile'
+
+_COMMAND_KEY = 'profiler:command'
+_RESULT_KEY = 'profiler:result:{0}'
+_EDGES_KEY = 'profiler:edges:{0}'
+_WORKERS_KEY = 'profiler:workers:{0}'
+_REQUEST_PROFILING_KEY = 'profiler:request:{0}'
+
+_last_command_id = None
+
+
+class SamplingProfiler(object):
+    """Statistical profiler that samples the stack of a thread at a fixed interval.
+    """
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id else main_thread().ident
+        self.stacks = Counter()
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        """Start sampling in a background thread.
+        """
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and return the sample count of each collapsed stack.
+        """
+        self._stopped.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[_collapse_frame(frame)] += 1
+
+
+def collapse(stacks):
+    """Format stack counts in the collapsed format consumed by flamegraph.pl.
+    """
+    return '\n'.join('{0} {1}'.format(stack, count) for stack, count in Counter(stacks).most_common())
+
+
+def broadcast_sampling(seconds, interval):
+    """Ask every worker to sample itself, returns the ID to fetch the results with.
+    """
+    command_id = str(uuid4()).replace('-', '')
+    command = json.dumps({'id': command_id, 'seconds': seconds, 'interval': interval, 'time': time.time()})
+    cache_database().set(_COMMAND_KEY, command, ex=int(seconds) + options.profiler_result_expire_after)
+    return command_id
+
+
+def enable_request_profiling(seconds):
+    """Profile requests carrying the returned token in the X-Profile header with cProfile.
+    """
+    token = str(uuid4()).replace('-', '')
+    cache_database().set(_REQUEST_PROFILING_KEY.format(token), 1, ex=max(int(seconds), 1))
+    return token
+
+
+def get_results(result_id):
+    """Returns the aggregated stacks and the number of reporting workers.
+    """
+    redis_client = cache_database()
+    stacks = {stack: int(count) for stack, count in redis_client.hgetall(_RESULT_KEY.format(result_id)).items()}
+    return collapse(stacks), redis_client.scard(_WORKERS_KEY.format(result_id))
+
+
+def get_edges(token):
+    """Returns the aggregated call edges of the requests profiled with cProfile and the number of reporting workers.
+    """
+    redis_client = cache_database()
+    edges = {edge: int(count) for edge, count in redis_client.hgetall(_EDGES_KEY.format(token)).items()}
+    return collapse(edges), redis_client.scard(_WORKERS_KEY.format(token))
+
+
+def start_request_profile(token):
+    """Returns an enabled cProfile.Profile if the token is valid, otherwise None.
+    """
+    try:
+        if not cache_database().exists(_REQUEST_PROFILING_KEY.format(token)):
+            return None
+    except:
+        return None
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def finish_request_profile(profile, token):
+    """Stop the profile and merge its call edges into the results.
+
+    cProfile keeps no stacks, each line is a caller;callee edge, or a root function alone, with the microseconds
+    spent in the callee itself when called from the caller. This is not a collapsed stack, flamegraph.pl would count
+    the time of a function once at every level it is called from.
+    """
+    profile.disable()
+    stacks = Counter()
+    for callee, (_, _, total_time, _, callers) in pstats.Stats(profile).stats.items():
+        if not callers:
+            stacks[_format_function(callee)] += int(total_time * 1000000)
+        for caller, (_, _, caller_total_time, _) in callers.items():
+            stacks['{0};{1}'.format(_format_function(caller), _format_function(callee))] += \
+                int(caller_total_time * 1000000)
+    _save_results(token, stacks, _EDGES_KEY)
+
+
+def install():
+    """Start polling for broadcast profiling commands, call it in each worker after forking.
+    """
+    tornado.ioloop.PeriodicCallback(_poll_command, options.profiler_poll_interval * 1000).start()
+
+
+def _poll_command():
+    global _last_command_id
+    try:
+        command = cache_database().get(_COMMAND_KEY)
+    except:
+        return
+    if not command:
+        return
+    command = json.loads(command)
+    if command['id'] == _last_command_id:
+        return
+    _last_command_id = command['id']
+    # The command stays in Redis long after it was issued, workers started since then only sample what is left.
+    seconds = command['time'] + command['seconds'] - time.time()
+    if seconds <= 0:
+        return
+    profiler = SamplingProfiler(command['interval'])
+    profiler.start()
+    tornado.ioloop.IOLoop.current().call_later(seconds,
+                                               lambda: _save_results(command['id'], profiler.stop()))
+
+
+def _save_results(result_id, stacks, result_key=_RESULT_KEY):
+    result_key, workers_key = result_key.format(result_id), _WORKERS_KEY.format(result_id)
+    pipeline = cache_database().pipeline()
+    for stack, count in stacks.items():
+        pipeline.hincrby(result_key, stack, count)
+    pipeline.sadd(workers_key, os.getpid())
+    pipeline.expire(result_key, options.profiler_result_expire_after)
+    pipeline.expire(workers_key, options.profiler_result_expire_after)
+    try:
+        pipeline.execute()
+    except:
+        logging.warning('Failed to save profiling results {0}.'.format(result_id))
+
+
+def _collapse_frame(frame):
+    functions = []
+    while frame is not None:
+        functions.append('{0}:{1}'.format(frame.f_globals.get('__name__', '?'), frame.f_code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(functions))
+
+
+def _format_function(function):
+    filename, line, name = function
+    return '{0}:{1}:{2}'.format(os.path.basename(filename), line, name) if line else name
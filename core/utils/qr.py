@@ -0,0 +1,33 @@
+from io import BytesIO
+import logging
+
+from tornado.options import options
+
+from core.caches import cache_database, LRUCache
+
+
+_svg_cache = LRUCache(options.qr_code_cache_size)
+
+
+def render_qr_svg(content):
+    """Returns the QR code of the content as SVG, contents are immutable so the SVG is cached once rendered.
+    """
+    svg = _svg_cache.get(content)
+    if svg is not None:
+        return svg
+    key = 'qrCode:{0}'.format(content)
+    try:
+        svg = cache_database().get(key)
+    except:
+        logging.warning('Failed to get QR code {0}.'.format(key))
+    if svg is None:
+        import pyqrcode
+        stream = BytesIO()
+        pyqrcode.create(content, error='H').svg(stream, scale=4, background='#fff', xmldecl=False, omithw=True)
+        svg = stream.getvalue().decode('utf-8')
+        try:
+            cache_database().set(key, svg, ex=options.qr_code_cache_expire_after)
+        except:
+            logging.warning('Failed to set QR code {0}.'.format(key))
+    _svg_cache.set(content, svg)
+    return svg
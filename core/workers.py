@@ -0,0 +1,37 @@
+import os
+import time
+import logging
+
+from core import models, feed, limiter, logs
+from core.utils import profiler
+
+
+# Imported first by main, so the startup timings below include importing the handlers.
+_started_at = time.time()
+_initialized_at = None
+_served_first_request = False
+
+
+def init_worker(imported_at):
+    """Initialize the worker after forking, connections must not be shared between workers.
+    """
+    global _initialized_at
+    logs.install()
+    models.init()
+    profiler.install()
+    feed.install()
+    limiter.install()
+    _initialized_at = time.time()
+    logging.info('Worker {0} started: imports {1:.2f} ms, init {2:.2f} ms.'
+                 .format(os.getpid(), (imported_at - _started_at) * 1000, (_initialized_at - imported_at) * 1000))
+
+
+def on_request_finished():
+    """Log the time to the first request of the worker.
+    """
+    global _served_first_request
+    if _served_first_request or _initialized_at is None:
+        return
+    _served_first_request = True
+    logging.info('Worker {0} served first request {1:.2f} ms after start.'
+                 .format(os.getpid(), (time.time() - _started_at) * 1000))
@@ -0,0 +1,32 @@
+"""Import customers of a seller from a CSV file, run from the project root:
+
+    python3 -m import_customers --import_seller_id=42 --import_file=customers.csv
+
+The first line names the columns, e.g. 姓名,性别,身份证,手机 or name,gender,identification,cellphone. The file is
+parsed line by line and inserted in batches of import_batch_size, rows with errors are reported and skipped.
+"""
+import logging
+
+import tornado.options
+
+tornado.options.define('import_seller_id', default=0, type=int)
+tornado.options.define('import_file', default='', type=str)
+
+import config
+from tornado.options import options
+
+from core import models
+from urvip.models import Customer
+
+
+if __name__ == '__main__':
+    models.init()
+    with open(options.import_file, encoding='utf-8-sig', newline='') as lines:
+        imported, errors = Customer.import_csv(
+            models.seller_database(options.import_seller_id), options.import_seller_id, lines,
+            options.import_batch_size,
+            lambda imported, failed: logging.info('Imported {0} customers, {1} errors.'.format(imported, failed)))
+    for line, message in errors:
+        logging.warning('Line {0}: {1}'.format(line, message))
+    logging.info('Imported {0} customers of seller {1}, {2} errors.'
+                 .format(imported, options.import_seller_id, len(errors)))
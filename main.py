@@ -1,4 +1,5 @@
 import os
+import time
 
 from tornado.options import options
 import tornado.web
@@ -6,21 +7,31 @@ import tornado.httpserver
 import tornado.ioloop
 
 import config
+from core.workers import init_worker
+from core.assets import AssetHandler, build
 from common.handlers import __handlers__ as common_handlers
 from urvip.handlers import __handlers__ as urvip_handlers
 from core.handlers import InvalidUrlHandler
+from core.logs import log_request
 
 
 def main():
+    imported_at = time.time()
     handlers = list()
     handlers.extend(common_handlers)
     handlers.extend(urvip_handlers)
     handlers.extend([(r'^.*$', InvalidUrlHandler)])
+    static_path = os.path.join(os.path.dirname(__file__), 'static')
+    if options.build_static_on_start:
+        build(static_path)
     application = tornado.web.Application(handlers=handlers, debug=options.debug, cookie_secret=options.cookie_secret,
-                                          template_path=os.path.join(os.path.dirname(__file__), 'templates'))
+                                          template_path=os.path.join(os.path.dirname(__file__), 'templates'),
+                                          static_path=static_path, static_handler_class=AssetHandler,
+                                          log_function=log_request)
     http_server = tornado.httpserver.HTTPServer(application)
     http_server.bind(options.port)
     http_server.start(options.num_processes)
+    init_worker(imported_at)
     tornado.ioloop.IOLoop.current().start()
 
 
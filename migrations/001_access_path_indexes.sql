@@ -0,0 +1,44 @@
+-- Indexes for Customer.list_by_page, Customer.list_transactions, Seller.list_transactions_by_page and
+-- ChargeRule.list. InnoDB builds them online, the tables stay writable while they are built.
+ALTER TABLE `customer`
+    ADD INDEX `ix_customer_seller_id_status_update_time` (`seller_id`, `status`, `update_time`),
+    ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE `charge_rule`
+    ADD INDEX `ix_charge_rule_seller_id_status` (`seller_id`, `status`),
+    ALGORITHM=INPLACE, LOCK=NONE;
+
+-- The seller's transactions are paged by create_time, copy seller_id from customer so that one index serves both
+-- the filter and the order.
+ALTER TABLE `transaction`
+    ADD COLUMN `seller_id` BIGINT NULL AFTER `customer_id`,
+    ADD INDEX `ix_transaction_customer_id_create_time` (`customer_id`, `create_time`),
+    ALGORITHM=INPLACE, LOCK=NONE;
+-- Backfill in batches of 10000 IDs, each batch in its own transaction, so that row locks are held briefly.
+DELIMITER //
+CREATE PROCEDURE `backfill_transaction_seller_id`()
+BEGIN
+    DECLARE batch_start BIGINT DEFAULT 0;
+    DECLARE max_id BIGINT DEFAULT (SELECT COALESCE(MAX(`id`), 0) FROM `transaction`);
+    WHILE batch_start < max_id DO
+        UPDATE `transaction` t JOIN `customer` c ON c.`id` = t.`customer_id`
+            SET t.`seller_id` = c.`seller_id`
+            WHERE t.`id` > batch_start AND t.`id` <= batch_start + 10000 AND t.`seller_id` IS NULL;
+        COMMIT;
+        SET batch_start = batch_start + 10000;
+    END WHILE;
+END //
+DELIMITER ;
+CALL `backfill_transaction_seller_id`();
+DROP PROCEDURE `backfill_transaction_seller_id`;
+-- Transactions are inserted with seller_id since this release. This fails if any row was missed, e.g. one whose
+-- customer is gone, fix those rows and run it again.
+ALTER TABLE `transaction`
+    MODIFY COLUMN `seller_id` BIGINT NOT NULL,
+    ALGORITHM=INPLACE, LOCK=NONE;
+-- Adding a foreign key in place requires foreign_key_checks to be disabled, the backfill above keeps it valid.
+SET foreign_key_checks = 0;
+ALTER TABLE `transaction`
+    ADD CONSTRAINT `transaction_ibfk_2` FOREIGN KEY (`seller_id`) REFERENCES `seller` (`id`),
+    ADD INDEX `ix_transaction_seller_id_create_time` (`seller_id`, `create_time`),
+    ALGORITHM=INPLACE, LOCK=NONE;
+SET foreign_key_checks = 1;
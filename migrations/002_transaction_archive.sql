@@ -0,0 +1,18 @@
+-- Monthly archived transaction counts of each seller and each customer, on the master database and every shard. The
+-- transaction_YYYYMM tables are created by archive_transactions.py.
+CREATE TABLE `transaction_archive` (
+    `seller_id` BIGINT NOT NULL,
+    `month` INT NOT NULL,
+    `count` BIGINT NULL,
+    PRIMARY KEY (`seller_id`, `month`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+CREATE TABLE `customer_archive` (
+    `id` BIGINT NOT NULL AUTO_INCREMENT,
+    `customer_id` BIGINT NULL,
+    `month` INT NULL,
+    `seller_id` BIGINT NULL,
+    `count` BIGINT NULL,
+    PRIMARY KEY (`id`),
+    UNIQUE INDEX `ix_customer_archive_customer_id_month` (`customer_id`, `month`),
+    INDEX `ix_customer_archive_seller_id` (`seller_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
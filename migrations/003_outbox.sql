@@ -0,0 +1,8 @@
+-- Feed events waiting to be published to Redis, on the master database and every shard, see core/feed.py.
+CREATE TABLE `outbox` (
+    `id` BIGINT NOT NULL AUTO_INCREMENT,
+    `payload` TEXT NULL,
+    `create_time` DATETIME NULL,
+    PRIMARY KEY (`id`),
+    INDEX `ix_outbox_create_time` (`create_time`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,8 @@
+-- Indexes for Customer.list_changes and ChargeRule.list_changes, which include deleted rows and therefore cannot use
+-- the (seller_id, status, ...) indexes. InnoDB builds them online.
+ALTER TABLE `customer`
+    ADD INDEX `ix_customer_seller_id_update_time` (`seller_id`, `update_time`),
+    ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE `charge_rule`
+    ADD INDEX `ix_charge_rule_seller_id_update_time` (`seller_id`, `update_time`),
+    ALGORITHM=INPLACE, LOCK=NONE;
@@ -0,0 +1,26 @@
+-- Results of urvip/analytics.py, on the master database and every shard.
+CREATE TABLE `customer_rfm` (
+    `customer_id` BIGINT NOT NULL,
+    `seller_id` BIGINT NULL,
+    `transaction_count` INT NULL,
+    `frequency` INT NULL,
+    `monetary` FLOAT NULL,
+    `first_time` DATETIME NULL,
+    `last_time` DATETIME NULL,
+    `recency_days` FLOAT NULL,
+    `recency_score` INT NULL,
+    `frequency_score` INT NULL,
+    `monetary_score` INT NULL,
+    `segment` VARCHAR(20) NULL,
+    `churn_score` FLOAT NULL,
+    `suggested_level` INT NULL,
+    `update_time` DATETIME NULL,
+    PRIMARY KEY (`customer_id`),
+    INDEX `ix_customer_rfm_seller_id` (`seller_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+CREATE TABLE `rfm_checkpoint` (
+    `seller_id` BIGINT NOT NULL,
+    `last_transaction_id` BIGINT NULL,
+    `update_time` DATETIME NULL,
+    PRIMARY KEY (`seller_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,13 @@
+-- Directory of the shard holding each seller's data, on the master database, see SellerShard in core/models.py.
+-- status: 1 normal, 5 moving.
+CREATE TABLE IF NOT EXISTS `seller_shard` (
+    `seller_id` BIGINT NOT NULL,
+    `shard` INT NOT NULL,
+    `status` INT NOT NULL,
+    PRIMARY KEY (`seller_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+-- Record the sellers added before sharding in the directory of the master database, as staying in the master
+-- database (shard -1, see MASTER_SHARD in core/models.py). Move them to shards with move_seller.py afterwards.
+INSERT INTO `seller_shard` (`seller_id`, `shard`, `status`)
+    SELECT s.`id`, -1, 1 FROM `seller` s
+    WHERE NOT EXISTS (SELECT 1 FROM `seller_shard` d WHERE d.`seller_id` = s.`id`);
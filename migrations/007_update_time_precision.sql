@@ -0,0 +1,8 @@
+-- Keep microseconds of update times, pages send them back for the optimistic checks of charge and consume and the
+-- sync cursor pages by them. Changing the type copies the tables, writes wait until it finishes.
+ALTER TABLE `customer`
+    MODIFY COLUMN `update_time` DATETIME(6) NULL,
+    ALGORITHM=COPY, LOCK=SHARED;
+ALTER TABLE `charge_rule`
+    MODIFY COLUMN `update_time` DATETIME(6) NULL,
+    ALGORITHM=COPY, LOCK=SHARED;
@@ -0,0 +1,159 @@
+"""Move a seller to another shard while the site keeps serving, run from the project root:
+
+    python3 -m move_seller --move_seller_id=42 --move_to_shard=3
+
+1. Copy the seller, its charge rules, customers, transactions, archived transactions and analytics to the target shard
+   while writes continue.
+2. Mark the seller as moving and wait for the workers' directory caches to expire, requests of the seller get 503.
+3. Copy the rows changed since step 1, check that both shards hold the same number of the seller's rows in every
+   table and point the directory at the target shard.
+4. Wait for the directory caches again and delete the seller's rows from the source shard.
+
+The seller is only unavailable during steps 2 and 3, which copy the changes made while step 1 ran. Do not run
+archive_transactions.py meanwhile, transactions it archives during step 1 fail the check of step 3, which leaves the
+seller on the source shard.
+"""
+from datetime import datetime
+import logging
+import time
+
+import tornado.options
+
+tornado.options.define('move_seller_id', default=0, type=int)
+tornado.options.define('move_to_shard', default=0, type=int)
+tornado.options.define('move_batch_size', default=1000, type=int)
+tornado.options.define('move_batch_interval', default=0.05, type=float)
+
+import config
+from tornado.options import options
+from sqlalchemy import and_, select, func
+
+from core import models
+from urvip.models import Seller, ChargeRule, Customer, Transaction, TransactionArchive, CustomerArchive, CustomerRfm, \
+    RfmCheckpoint
+
+
+_ARCHIVE_COUNT_TABLES = {TransactionArchive.__table__, CustomerArchive.__table__}
+_ANALYTICS_TABLES = {CustomerRfm.__table__, RfmCheckpoint.__table__}
+
+
+def seller_tables(db, seller_id):
+    """Tables holding the seller's rows as (table, where, key) tuples, parents first, the foreign keys of the target
+    shard must be satisfied. Rows are copied in the order of their keys.
+    """
+    tables = [(Seller.__table__, Seller.__table__.c.id == seller_id, Seller.__table__.c.id)]
+    for model in (ChargeRule, Customer, Transaction):
+        tables.append((model.__table__, model.__table__.c.seller_id == seller_id, model.__table__.c.id))
+    for archive in db.query(TransactionArchive.month).filter(TransactionArchive.sellerId == seller_id)\
+                     .order_by(TransactionArchive.month):
+        table = Transaction.archive_table(archive.month)
+        tables.append((table, table.c.seller_id == seller_id, table.c.id))
+    for model, key in ((TransactionArchive, 'month'), (CustomerArchive, 'id'), (CustomerRfm, 'customer_id'),
+                       (RfmCheckpoint, 'seller_id')):
+        tables.append((model.__table__, model.__table__.c.seller_id == seller_id, model.__table__.c[key]))
+    return tables
+
+
+def copy_rows(source, target, table, where, key, after=0):
+    """Copy rows matching where with key greater than after in batches, returns the last key.
+
+    IDs must be unique across shards, see shard_database_urls in config.py.sample.
+    """
+    while True:
+        rows = source.execute(table.select().where(and_(where, key > after))
+                              .order_by(key).limit(options.move_batch_size)).fetchall()
+        if not rows:
+            return after
+        values = [dict(row) for row in rows]
+        # Only the seller's own rows are replaced, an ID used by another seller fails the insert and stops the move.
+        target.execute(table.delete().where(and_(where, key.in_([v[key.name] for v in values]))))
+        target.execute(table.insert(), values)
+        target.commit()
+        after = values[-1][key.name]
+        time.sleep(options.move_batch_interval)
+
+
+def delete_rows(db, table, where, key):
+    """Delete rows matching where in batches.
+    """
+    while True:
+        keys = [row[0] for row in db.execute(select([key]).where(where).limit(options.move_batch_size))]
+        if not keys:
+            return
+        db.execute(table.delete().where(and_(where, key.in_(keys))))
+        db.commit()
+        time.sleep(options.move_batch_interval)
+
+
+def count_rows(db, table, where):
+    return db.execute(select([func.count()]).select_from(table).where(where)).scalar()
+
+
+def is_archive(table):
+    return table.metadata is Transaction._archive_metadata
+
+
+def create_archive_tables(target, tables):
+    # DDL commits implicitly in MySQL, the tables are created before any batch is copied.
+    for table, _, _ in tables:
+        if is_archive(table):
+            table.create(bind=target.connection(), checkfirst=True)
+            target.commit()
+
+
+def move_seller(seller_id, target_shard):
+    if models.shard_count() == 0:
+        raise Exception('Sharding is not configured.')
+    if target_shard not in models.shards():
+        raise Exception('Shard {0} does not exist.'.format(target_shard))
+    source_shard = models.seller_shard(seller_id)
+    if source_shard == target_shard:
+        logging.info('Seller {0} is already on shard {1}.'.format(seller_id, target_shard))
+        return
+    source, target = models.shard_database(source_shard), models.shard_database(target_shard)
+    # The master database holds every seller, its row there is neither replaced nor deleted.
+    skipped = {Seller.__table__} if target_shard == models.MASTER_SHARD else set()
+    kept = {Seller.__table__} if source_shard == models.MASTER_SHARD else set()
+    tables = [t for t in seller_tables(source, seller_id) if t[0] not in skipped]
+    create_archive_tables(target, tables)
+    copy_started_at = datetime.now()
+    logging.info('Copying seller {0} from shard {1} to shard {2}.'.format(seller_id, source_shard, target_shard))
+    last_keys = {table.name: copy_rows(source, target, table, where, key) for table, where, key in tables}
+    analytics_time = source.query(RfmCheckpoint.updateTime).filter(RfmCheckpoint.sellerId == seller_id).scalar()
+    logging.info('Freezing seller {0}.'.format(seller_id))
+    models.set_seller_shard(seller_id, source_shard, status=5)
+    time.sleep(options.shard_directory_cache_ttl + 1)
+    source.rollback()
+    # Archiving may have added months meanwhile.
+    tables = [t for t in seller_tables(source, seller_id) if t[0] not in skipped]
+    create_archive_tables(target, tables)
+    analytics_changed = analytics_time != source.query(RfmCheckpoint.updateTime)\
+                                               .filter(RfmCheckpoint.sellerId == seller_id).scalar()
+    for table, where, key in tables:
+        if table is Transaction.__table__ or is_archive(table):
+            # Transactions are only ever inserted.
+            copy_rows(source, target, table, where, key, after=last_keys.get(table.name, 0))
+        elif table in _ARCHIVE_COUNT_TABLES or (analytics_changed and table in _ANALYTICS_TABLES):
+            # Rewritten as a whole by the archiver and the analytics refresh.
+            delete_rows(target, table, where, key)
+            copy_rows(source, target, table, where, key)
+        elif table not in _ANALYTICS_TABLES:
+            copy_rows(source, target, table, and_(where, table.c.update_time >= copy_started_at), key)
+    for table, where, _ in tables:
+        source_count, target_count = count_rows(source, table, where), count_rows(target, table, where)
+        if source_count != target_count:
+            models.set_seller_shard(seller_id, source_shard)
+            raise Exception('Seller {0} has {1} rows in {2} of shard {3} but {4} in shard {5}, it stays on shard {3}.'
+                            .format(seller_id, source_count, table.name, source_shard, target_count, target_shard))
+    models.set_seller_shard(seller_id, target_shard)
+    logging.info('Seller {0} is served by shard {1}.'.format(seller_id, target_shard))
+    time.sleep(options.shard_directory_cache_ttl + 1)
+    for table, where, key in reversed(seller_tables(source, seller_id)):
+        if table not in kept:
+            delete_rows(source, table, where, key)
+    logging.info('Deleted seller {0} from shard {1}.'.format(seller_id, source_shard))
+
+
+if __name__ == '__main__':
+    models.init()
+    move_seller(options.move_seller_id, options.move_to_shard)
@@ -0,0 +1,42 @@
+"""Refresh the RFM analytics of customers, run from the project root, e.g. nightly by cron:
+
+    python3 -m refresh_analytics --analytics_seller_id=42
+
+Without analytics_seller_id every active seller is refreshed. Each run only reads the transactions added since the
+previous one, --analytics_full recomputes from all transactions, e.g. after changing the scoring. With
+--analytics_apply_level the suggested levels are written to the customers and pushed to open pages as well.
+Transactions of the last sync_settle_time seconds are left to the next run, a transaction committing late could
+otherwise have an ID below the one the run stopped at. See urvip.analytics.
+"""
+import logging
+import time
+
+import tornado.options
+
+tornado.options.define('analytics_seller_id', default=0, type=int)
+tornado.options.define('analytics_full', default=False, type=bool)
+tornado.options.define('analytics_apply_level', default=False, type=bool)
+tornado.options.define('analytics_chunk_size', default=10000, type=int)
+
+import config
+from tornado.options import options
+
+from core import models
+from urvip import analytics
+from urvip.models import Seller
+
+
+if __name__ == '__main__':
+    models.init()
+    if options.analytics_seller_id:
+        seller_ids = [options.analytics_seller_id]
+    else:
+        seller_ids = [row.id for row in models.read_write_database().query(Seller.id).filter(Seller.status == 1)
+                                                                     .order_by(Seller.id)]
+    for seller_id in seller_ids:
+        start = time.time()
+        count = analytics.refresh(models.seller_database(seller_id), seller_id, options.analytics_full,
+                                  options.analytics_apply_level, options.analytics_chunk_size,
+                                  options.sync_settle_time)
+        logging.info('Refreshed the analytics of {0} customers of seller {1} in {2:.1f}s.'
+                     .format(count, seller_id, time.time() - start))
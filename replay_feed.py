@@ -0,0 +1,46 @@
+"""Replay the customer change feed, run from the project root:
+
+    python3 -m replay_feed --replay_since='2017-01-01 00:00:00' --replay_group=accounting
+
+Rewinds the consumer group so that its consumers receive the events published since the given time again. Without
+--replay_group the events are printed as JSON lines instead. The stream keeps about feed_max_length events.
+"""
+from datetime import datetime
+import logging
+
+import tornado.options
+
+tornado.options.define('replay_since', default='', type=str)
+tornado.options.define('replay_group', default='', type=str)
+tornado.options.define('replay_batch_size', default=1000, type=int)
+
+import config
+from tornado.options import options
+
+from core import feed
+from core.caches import cache_database
+
+
+def print_events(since):
+    """Print the events published since the given datetime.
+    """
+    start = '{0}-0'.format(int(since.timestamp() * 1000))
+    while True:
+        entries = cache_database().execute_command('XRANGE', feed.STREAM_KEY, start, '+',
+                                                   'COUNT', options.replay_batch_size)
+        for id, fields in entries:
+            print(dict(zip(fields[::2], fields[1::2]))['event'])
+        if len(entries) < options.replay_batch_size:
+            return
+        # Continue after the last entry.
+        milliseconds, sequence = entries[-1][0].split('-')
+        start = '{0}-{1}'.format(milliseconds, int(sequence) + 1)
+
+
+if __name__ == '__main__':
+    since = datetime.strptime(options.replay_since, '%Y-%m-%d %H:%M:%S')
+    if options.replay_group:
+        stream_id = feed.set_group_position(options.replay_group, since)
+        logging.info('Group {0} continues after {1}.'.format(options.replay_group, stream_id))
+    else:
+        print_events(since)
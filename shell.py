@@ -1,7 +1,10 @@
 import config
-from core.models import _engine, BaseModel, read_write_database
+from core.models import init, engine, shard_count, shard_engine, BaseModel, read_write_database
 from urvip.models import Seller, Admin, ChargeRule, Customer, Transaction
 
 
-BaseModel.metadata.create_all(_engine)
+init()
+BaseModel.metadata.create_all(engine())
+for shard in range(shard_count()):
+    BaseModel.metadata.create_all(shard_engine(shard))
 db = read_write_database()
@@ -43,3 +43,23 @@ function logout() {
     document.cookie = "sessionId='';path=/;expires=" + (new Date()).toGMTString();
     window.location.reload();
 }
+
+function openLive(onChange, retryDelay) {
+    if (!window.WebSocket) {
+        return;
+    }
+    retryDelay = retryDelay || 1000;
+    var scheme = (window.location.protocol == "https:") ? "wss://" : "ws://";
+    var socket = new WebSocket(scheme + window.location.host + "/live");
+    socket.onopen = function() {
+        retryDelay = 1000;
+    };
+    socket.onmessage = function(event) {
+        onChange(JSON.parse(event.data));
+    };
+    socket.onclose = function() {
+        setTimeout(function() {
+            openLive(onChange, Math.min(retryDelay * 2, 60000));
+        }, retryDelay);
+    };
+}
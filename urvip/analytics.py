@@ -0,0 +1,218 @@
+"""会员RFM分析
+
+按商户一次流式读取充值、消费记录的列, 用NumPy向量化计算每个会员的最近一次交易距今天数(R), 消费次数(F)和
+充值金额(M), 按商户内五分位打分, 划分分群, 估计流失概率并给出建议的会员等级, 结果批量写入customer_rfm.
+累计值保存在customer_rfm中, 之后只读取上次处理的记录ID之后的记录.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select, and_, or_, bindparam, func
+
+from core import feed, live
+from urvip.models import Seller, Customer, Transaction, TransactionArchive, CustomerRfm, RfmCheckpoint
+
+
+_MICROSECONDS_PER_DAY = 24 * 60 * 60 * 1000000
+_NO_TIME = np.iinfo(np.int64).min
+_FIRST_UNSET = np.iinfo(np.int64).max
+# 按顺序匹配, 都不满足的是regular
+_SEGMENTS = ('champion', 'loyal', 'new', 'atRisk', 'lost', 'hibernating')
+
+
+def refresh(db, seller_id, full=False, apply_level=False, chunk_size=10000, settle_time=2, now=None):
+    """刷新商户所有正常会员的分析结果, 返回分析的会员数
+
+    full为真时忽略已保存的累计值重新计算, apply_level为真时将建议等级写入会员的level并推送变更.
+    记录ID在插入时分配, 提交有先后, 只处理settle_time秒之前的记录, 避免已处理到的ID之前还有提交较晚的记录.
+    """
+    now = now or datetime.now()
+    checkpoint = db.query(RfmCheckpoint).filter(RfmCheckpoint.sellerId == seller_id).first()
+    after_id = checkpoint.lastTransactionId if checkpoint and not full else 0
+    before_id = _first_unsettled_id(db, seller_id, after_id, now - timedelta(seconds=settle_time))
+    customers = db.execute(select([Customer.__table__.c.id, Customer.__table__.c.create_time,
+                                   Customer.__table__.c.level])
+                           .where(and_(Customer.__table__.c.seller_id == seller_id,
+                                       Customer.__table__.c.status == 1))
+                           .order_by(Customer.__table__.c.id)).fetchall()
+    ids = np.array([c.id for c in customers], dtype=np.int64)
+    stats = _load_stats(db, seller_id, ids) if after_id else _empty_stats(len(ids))
+    last_id = after_id
+    for chunk in _stream_transactions(db, seller_id, after_id, before_id, chunk_size):
+        _accumulate(stats, ids, *chunk)
+        last_id = max(last_id, int(chunk[0].max()))
+    created = _to_microseconds([c.create_time for c in customers])
+    scores = score(stats, created, _to_microseconds([now])[0])
+    _save(db, seller_id, ids, stats, scores, now)
+    db.merge(RfmCheckpoint(sellerId=seller_id, lastTransactionId=last_id, updateTime=now))
+    db.commit()
+    if apply_level:
+        levels = np.array([c.level or 0 for c in customers], dtype=np.int64)
+        changed = np.nonzero(levels != scores['suggestedLevel'])[0]
+        for start in range(0, len(changed), 1000):
+            _apply_levels(db, seller_id, [[int(ids[i]), int(scores['suggestedLevel'][i])]
+                                          for i in changed[start:start + 1000]])
+        if len(changed):
+            Seller.bump_data_version(seller_id)
+    return len(ids)
+
+
+def score(stats, created, now):
+    """由累计值计算分数、分群、流失概率和建议等级, 时间均为微秒
+    """
+    count = len(created)
+    if not count:
+        return {name: np.zeros(0) for name in ('recencyDays', 'recencyScore', 'frequencyScore', 'monetaryScore',
+                                               'segment', 'churnScore', 'suggestedLevel')}
+    active = stats['transactionCount'] > 0
+    # 没有交易的会员从入会时间算起, 新会员不会被当作流失
+    last_seen = np.where(active, stats['lastTime'], created)
+    recency = np.maximum(now - last_seen, 0) / _MICROSECONDS_PER_DAY
+    r = 6 - _quintile(recency)
+    f = _quintile(stats['frequency'])
+    m = _quintile(stats['monetary'])
+    segment = np.select([(r >= 4) & (f >= 4), (r >= 3) & (f >= 4), (r >= 4) & (stats['frequency'] <= 1),
+                         (r <= 2) & (f >= 3), r == 1, r == 2],
+                        np.array(_SEGMENTS, dtype=object), default='regular')
+    # 假设交易间隔服从指数分布, 均值取会员自己的平均间隔, 交易不足两次的取商户中位数
+    repeated = stats['transactionCount'] >= 2
+    intervals = np.full(count, np.nan)
+    intervals[repeated] = (stats['lastTime'][repeated] - stats['firstTime'][repeated]) / \
+        (stats['transactionCount'][repeated] - 1) / _MICROSECONDS_PER_DAY
+    typical = np.median(intervals[repeated]) if repeated.any() else 30.0
+    intervals = np.maximum(np.where(np.isnan(intervals), typical, intervals), 1.0)
+    churn = 1 - np.exp(-recency / intervals)
+    return {'recencyDays': recency, 'recencyScore': r, 'frequencyScore': f, 'monetaryScore': m,
+            'segment': segment, 'churnScore': churn,
+            'suggestedLevel': np.clip(np.rint((f + m) / 2), 1, 5).astype(np.int64)}
+
+
+def _apply_levels(db, seller_id, customer_levels):
+    """将一批会员的等级改为建议等级, 单独提交并推送变更
+
+    更新时间取提交前的当前时间, 不能用分析开始的时间: 分析大商户要几分钟, 早于sync_settle_time的更新时间
+    会被增量同步漏掉, 也可能早于分析期间的充值、消费. 更新时间已不早于此时间的会员不修改, 更新时间不会倒退.
+    """
+    table = Customer.__table__
+    now = datetime.now()
+    # 会员等级变化也要让同步接口和缓存看到
+    db.execute(table.update().where(and_(table.c.id == bindparam('customer_id'),
+                                         or_(table.c.update_time.is_(None), table.c.update_time < now)))
+               .values(level=bindparam('new_level'), update_time=now),
+               [{'customer_id': id, 'new_level': level} for id, level in customer_levels])
+    change = {'type': 'levelsChanged', 'sellerId': seller_id, 'customerLevels': customer_levels}
+    event = feed.record(db, change)
+    db.commit()
+    feed.publish(db, event)
+    # 打开的页面据此更新会员的更新时间, 之后的充值、消费不会因版本冲突失败
+    live.publish(Seller.live_channel(seller_id), dict(change, updateTime=now.timestamp()))
+
+
+def _quintile(values):
+    # 等于分位点的值计入较低的一档, 大量为0的会员都得1分
+    thresholds = np.percentile(values, [20, 40, 60, 80])
+    return 1 + np.searchsorted(thresholds, values, side='left')
+
+
+def _empty_stats(count):
+    return {'transactionCount': np.zeros(count, dtype=np.int64), 'frequency': np.zeros(count, dtype=np.int64),
+            'monetary': np.zeros(count), 'firstTime': np.full(count, _FIRST_UNSET, dtype=np.int64),
+            'lastTime': np.full(count, _NO_TIME, dtype=np.int64)}
+
+
+def _load_stats(db, seller_id, ids):
+    stats = _empty_stats(len(ids))
+    table = CustomerRfm.__table__
+    rows = db.execute(select([table.c.customer_id, table.c.transaction_count, table.c.frequency, table.c.monetary,
+                              table.c.first_time, table.c.last_time])
+                      .where(table.c.seller_id == seller_id)).fetchall()
+    if not rows or not len(ids):
+        return stats
+    columns = list(zip(*rows))
+    index, found = _locate(ids, np.array(columns[0], dtype=np.int64))
+    stats['transactionCount'][index] = np.array(columns[1], dtype=np.int64)[found]
+    stats['frequency'][index] = np.array(columns[2], dtype=np.int64)[found]
+    stats['monetary'][index] = np.array(columns[3], dtype=np.float64)[found]
+    first = _to_microseconds(columns[4])[found]
+    stats['firstTime'][index] = np.where(first == _NO_TIME, _FIRST_UNSET, first)
+    stats['lastTime'][index] = _to_microseconds(columns[5])[found]
+    return stats
+
+
+def _first_unsettled_id(db, seller_id, after_id, settle_before):
+    """after_id之后第一个settle_before之后创建的记录ID, 没有时为None
+    """
+    table = Transaction.__table__
+    return db.execute(select([func.min(table.c.id)])
+                      .where(and_(table.c.seller_id == seller_id, table.c.id > after_id,
+                                  table.c.create_time >= settle_before))).scalar()
+
+
+def _stream_transactions(db, seller_id, after_id, before_id, chunk_size):
+    """逐块返回ID在after_id和before_id之间的记录的ID, 会员ID, 类别, 余额变动和时间的数组, 包括已归档的记录
+    """
+    tables = [Transaction.__table__] + [Transaction.archive_table(a.month) for a in
+                                         db.query(TransactionArchive.month)
+                                           .filter(TransactionArchive.sellerId == seller_id)]
+    connection = db.connection().execution_options(stream_results=True)
+    for table in tables:
+        condition = and_(table.c.seller_id == seller_id, table.c.id > after_id)
+        if before_id is not None:
+            condition = and_(condition, table.c.id < before_id)
+        result = connection.execute(select([table.c.id, table.c.customer_id, table.c.kind, table.c.balance_change,
+                                            table.c.create_time]).where(condition))
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            columns = list(zip(*rows))
+            yield (np.array(columns[0], dtype=np.int64), np.array(columns[1], dtype=np.int64),
+                   np.array(columns[2], dtype=np.int64), np.array(columns[3], dtype=np.float64),
+                   _to_microseconds(columns[4]))
+
+
+def _accumulate(stats, ids, transaction_ids, customer_ids, kinds, balance_changes, times):
+    index, found = _locate(ids, customer_ids)
+    kinds, balance_changes, times = kinds[found], balance_changes[found], times[found]
+    count = len(ids)
+    stats['transactionCount'] += np.bincount(index, minlength=count)
+    stats['frequency'] += np.bincount(index, weights=kinds == 5, minlength=count).astype(np.int64)
+    stats['monetary'] += np.bincount(index, weights=np.where(kinds == 1, balance_changes, 0), minlength=count)
+    np.minimum.at(stats['firstTime'], index, times)
+    np.maximum.at(stats['lastTime'], index, times)
+
+
+def _locate(ids, values):
+    """values在有序数组ids中的位置, 及values中哪些在ids中
+    """
+    if not len(ids):
+        return np.zeros(0, dtype=np.int64), np.zeros(len(values), dtype=bool)
+    index = np.minimum(np.searchsorted(ids, values), len(ids) - 1)
+    found = ids[index] == values
+    return index[found], found
+
+
+def _save(db, seller_id, ids, stats, scores, now):
+    table = CustomerRfm.__table__
+    db.execute(table.delete().where(table.c.seller_id == seller_id))
+    if not len(ids):
+        return
+    first = _to_datetimes(np.where(stats['firstTime'] == _FIRST_UNSET, _NO_TIME, stats['firstTime']))
+    last = _to_datetimes(stats['lastTime'])
+    columns = [ids.tolist(), stats['transactionCount'].tolist(), stats['frequency'].tolist(),
+               stats['monetary'].tolist(), first, last, scores['recencyDays'].round(2).tolist(),
+               scores['recencyScore'].tolist(), scores['frequencyScore'].tolist(), scores['monetaryScore'].tolist(),
+               scores['segment'].tolist(), scores['churnScore'].round(3).tolist(), scores['suggestedLevel'].tolist()]
+    names = ['customer_id', 'transaction_count', 'frequency', 'monetary', 'first_time', 'last_time', 'recency_days',
+             'recency_score', 'frequency_score', 'monetary_score', 'segment', 'churn_score', 'suggested_level']
+    rows = [dict(zip(names, values), seller_id=seller_id, update_time=now) for values in zip(*columns)]
+    for start in range(0, len(rows), 1000):
+        db.execute(table.insert(), rows[start:start + 1000])
+
+
+def _to_microseconds(times):
+    return np.array(times, dtype='datetime64[us]').astype(np.int64)
+
+
+def _to_datetimes(microseconds):
+    return microseconds.astype('datetime64[us]').astype(object).tolist()
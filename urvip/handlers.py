@@ -1,10 +1,35 @@
-from datetime import datetime
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime, timedelta
+from io import StringIO
+import json
+import re
+
+from tornado.options import options
+from tornado import gen
+import tornado.web
+
+from core import live
+from core.coalescer import Coalescer
+from core.decorators import require_login
+from core.handlers import PageHandler, ApiHandler, SocketHandler
+from core.models import UpdateConflictError
+from core.utils.qr import render_qr_svg
+from urvip.models import Seller, Admin, ChargeRule, Customer, LedgerOperation
 
-import pyqrcode
 
-from core.decorators import require_login
-from core.handlers import PageHandler, ApiHandler
-from urvip.models import Seller, Admin, ChargeRule, Customer
+_ledger_coalescer = None
+
+
+@gen.coroutine
+def _apply_ledger(db, operation):
+    """合并同一数据库几毫秒内的充值、消费操作一起提交, 会员不存在或已被修改时返回409, 接口状态码8
+    """
+    global _ledger_coalescer
+    if _ledger_coalescer is None:
+        _ledger_coalescer = Coalescer(Customer.apply_ledger, options.ledger_coalesce_delay,
+                                      options.ledger_coalesce_max_batch)
+    if not (yield _ledger_coalescer.submit(db, operation)):
+        raise tornado.web.HTTPError(409)
 
 
 class LoginHandler(PageHandler):
@@ -21,8 +46,9 @@ class LoginHandler(PageHandler):
         except:
             return self.redirect('login')
         else:
+            permissions = ['profile'] if admin.id in options.profiler_admin_ids else []
             session_id, expire_time = self.generate_session(admin.id, sellerId=admin.sellerId,
-                                                            permissions=[], cellphone=cellphone)
+                                                            permissions=permissions, cellphone=cellphone)
             self.set_secure_cookie('sessionId', session_id, expires=expire_time)
             return self.redirect('/customers', permanent=False)
 
@@ -30,6 +56,8 @@ class LoginHandler(PageHandler):
 class SendCaptchaHandler(ApiHandler):
     """发送验证码
     """
+    rate_limits = (('ip', 1 / 60, 3), ('route', 10, 50))
+
     def post(self, *args, **kwargs):
         cellphone = self.get_str_argument('cellphone')
         Admin.send_auth_captcha(self.db, cellphone)
@@ -41,7 +69,10 @@ class ChargeRulesHandler(PageHandler):
     """
     @require_login
     def get(self, *args, **kwargs):
-        charge_rules = ChargeRule.list(self.db, self.current_user.sellerId)
+        version = Seller.get_data_version(self.current_user.sellerId)
+        if self.check_not_modified('chargeRules:{0}'.format(version) if version is not None else None):
+            return
+        charge_rules = ChargeRule.list(self.seller_db, self.current_user.sellerId)
         return self.render('urvip/charge_rules.html', user_name=self.current_user.cellphone, charge_rules=charge_rules)
 
 
@@ -55,7 +86,8 @@ class AddChargeRuleHandler(ApiHandler):
         balance_change = self.get_float_argument('balanceChange')
         quantity_change = self.get_float_argument('quantityChange')
         score_change = self.get_float_argument('scoreChange')
-        ChargeRule.add(self.db, self.current_user.sellerId, name, payout, balance_change, quantity_change, score_change)
+        ChargeRule.add(self.seller_db, self.current_user.sellerId, name, payout, balance_change, quantity_change,
+                       score_change)
         return self.api_succeed()
 
 
@@ -65,28 +97,49 @@ class DeleteChargeRuleHandler(ApiHandler):
     @require_login
     def post(self, *args, **kwargs):
         id = self.get_int_argument('id')
-        ChargeRule.delete(self.db, self.current_user.sellerId, id)
+        ChargeRule.delete(self.seller_db, self.current_user.sellerId, id)
         return self.api_succeed()
 
 
 class CustomersHandler(PageHandler):
     """会员列表
     """
+    access_log_sample_rate = 0.1
+
     @require_login
     def get(self, *args, **kwargs):
         page_num = self.get_int_argument('page')
         card = self.get_str_argument('card')
         cellphone = self.get_str_argument('cellphone')
+        seller_id = self.current_user.sellerId
+        version = Seller.get_data_version(seller_id)
+        if self.check_not_modified('customers:{0}:{1}:{2}:{3}'.format(version, page_num, card, cellphone)
+                                  if version is not None else None):
+            return
+        # 版本号未知时不使用缓存的片段
+        cached = version is not None
         if not card and not cellphone:
-            customers, page_num, page_count = Customer.list_by_page(self.db, self.current_user.sellerId, page_num)
+            customer_table = self.get_fragment('fragment:customers:{0}:{1}:{2}'.format(seller_id, version, page_num)
+                                               if cached else None,
+                                               lambda: self.render_customer_table(
+                                                   *Customer.list_by_page(self.seller_db, seller_id, page_num)))
         else:
-            customer = Customer.get(self.db, self.current_user.sellerId, card=card, cellphone=cellphone)
-            customers, page_num, page_count = [customer] if customer else [], 0, 1
-        charge_rules = ChargeRule.list(self.db, self.current_user.sellerId)
+            customer = Customer.get(self.seller_db, seller_id, card=card, cellphone=cellphone)
+            customer_table = self.render_customer_table([customer] if customer else [], 0, 1)
+        charge_rule_options = self.get_fragment('fragment:chargeRules:{0}:{1}'.format(seller_id, version)
+                                                if cached else None,
+                                                lambda: self.render_charge_rule_options(seller_id))
         return self.render('urvip/customers.html',
                            user_name=self.current_user.cellphone,
-                           customers=customers, page_num=page_num, page_count=page_count,
-                           charge_rules=[r for r in charge_rules])
+                           customer_table=customer_table, charge_rule_options=charge_rule_options)
+
+    def render_customer_table(self, customers, page_num, page_count):
+        return self.render_string('urvip/customer_table.html',
+                                  customers=customers, page_num=page_num, page_count=page_count).decode('utf-8')
+
+    def render_charge_rule_options(self, seller_id):
+        return self.render_string('urvip/charge_rule_options.html',
+                                  charge_rules=ChargeRule.list(self.seller_db, seller_id)).decode('utf-8')
 
 
 class AddCustomerHandler(ApiHandler):
@@ -98,17 +151,38 @@ class AddCustomerHandler(ApiHandler):
         name = self.get_str_argument('name')
         gender = self.get_int_argument('gender')
         cellphone = self.get_str_argument('cellphone')
-        Customer.add(self.db, self.current_user.sellerId, identification, name, gender, cellphone)
+        Customer.add(self.seller_db, self.current_user.sellerId, identification, name, gender, cellphone)
         return self.api_succeed()
 
 
+class ImportCustomersHandler(ApiHandler):
+    """从CSV文件批量导入会员, 第一行是列名: 姓名,性别,身份证,手机
+    """
+    rate_limits = (('seller', 1 / 60, 3),)
+
+    @require_login
+    @gen.coroutine
+    def post(self, *args, **kwargs):
+        try:
+            lines = StringIO(self.request.files['file'][0]['body'].decode('utf-8-sig'), newline='')
+        except:
+            return self.api_failed(1, 'Invalid file.')
+        imported, errors = 0, []
+        for imported, errors in Customer.import_batches(self.seller_db, self.current_user.sellerId, lines,
+                                                        options.import_batch_size):
+            # 每批之间让出IOLoop, 大文件导入时不阻塞其他请求
+            yield gen.moment
+        return self.api_succeed({'imported': imported,
+                                 'errors': [{'line': line, 'message': message} for line, message in errors]})
+
+
 class DeleteCustomerHandler(ApiHandler):
     """删除会员
     """
     @require_login
     def post(self, *args, **kwargs):
         id = self.get_int_argument('id')
-        Customer.delete(self.db, self.current_user.sellerId, id)
+        Customer.delete(self.seller_db, self.current_user.sellerId, id)
         return self.api_succeed()
 
 
@@ -116,24 +190,37 @@ class ChargeHandler(ApiHandler):
     """会员充值
     """
     @require_login
+    @gen.coroutine
     def post(self, *args, **kwargs):
         customer_id = self.get_int_argument('customerId')
         old_update_time = self.get_float_argument('updateTime')
         charge_rule_id = self.get_int_argument('chargeRuleId')
         comments = self.get_str_argument('comments')
-        Customer.charge(self.db, self.current_user.sellerId, customer_id, old_update_time, charge_rule_id, comments)
+        if options.ledger_coalesce:
+            yield _apply_ledger(self.seller_db, LedgerOperation(1, self.current_user.sellerId, customer_id,
+                                                                old_update_time, charge_rule_id, 0, 0, 0, comments,
+                                                                None))
+        else:
+            try:
+                Customer.charge(self.seller_db, self.current_user.sellerId, customer_id, old_update_time,
+                                charge_rule_id, comments)
+            except UpdateConflictError:
+                raise tornado.web.HTTPError(409)
         return self.api_succeed()
 
 
 class SendConsumeCaptchaHandler(ApiHandler):
     """发送消费验证码
     """
+    rate_limits = (('seller', 1, 10), ('route', 10, 50))
+
     @require_login
     def post(self, *args, **kwargs):
         customer_id = self.get_int_argument('customerId')
         cellphone = self.get_str_argument('cellphone')
         old_update_time = self.get_float_argument('updateTime')
-        Customer.send_consume_captcha(self.db, self.current_user.sellerId, customer_id, cellphone, old_update_time)
+        Customer.send_consume_captcha(self.seller_db, self.current_user.sellerId, customer_id, cellphone,
+                                      old_update_time)
         return self.api_succeed()
 
 
@@ -141,6 +228,7 @@ class ConsumeHandler(ApiHandler):
     """会员消费
     """
     @require_login
+    @gen.coroutine
     def post(self, *args, **kwargs):
         customer_id = self.get_int_argument('customerId')
         old_update_time = self.get_float_argument('updateTime')
@@ -149,32 +237,124 @@ class ConsumeHandler(ApiHandler):
         score_change = self.get_int_argument('scoreChange')
         comments = self.get_str_argument('comments')
         captcha = self.get_str_argument('captcha')
-        Customer.consume(self.db, self.current_user.sellerId, customer_id, old_update_time,
-                         balance_change, quantity_change, score_change, comments, captcha)
+        if options.ledger_coalesce:
+            yield _apply_ledger(self.seller_db, LedgerOperation(5, self.current_user.sellerId, customer_id,
+                                                                old_update_time, 0, balance_change, quantity_change,
+                                                                score_change, comments, captcha))
+        else:
+            try:
+                Customer.consume(self.seller_db, self.current_user.sellerId, customer_id, old_update_time,
+                                 balance_change, quantity_change, score_change, comments, captcha)
+            except UpdateConflictError:
+                raise tornado.web.HTTPError(409)
         return self.api_succeed()
 
 
 class CustomerDetailHandler(PageHandler):
     """会员充值和消费的历史记录
     """
+    access_log_sample_rate = 0.1
+
     @require_login
     def get(self, *args, **kwargs):
         id = self.get_int_argument('id')
         card = self.get_str_argument('card')
         cellphone = self.get_str_argument('cellphone')
-        customer = Customer.get(self.db, self.current_user.sellerId, id=id, card=card, cellphone=cellphone)
+        validator = Customer.get_validator(self.seller_db, self.current_user.sellerId, id=id, card=card,
+                                           cellphone=cellphone)
+        if validator and self.check_not_modified('customerDetail:{0}:{1}'.format(validator.id,
+                                                                                 validator.updateTime.timestamp()),
+                                                 validator.updateTime):
+            return
+        customer = Customer.get(self.seller_db, self.current_user.sellerId, id=id, card=card, cellphone=cellphone)
         return self.render('urvip/customer_detail.html',
-                           customer=customer, qr_code=pyqrcode.create(customer.card).text(),
-                           transactions=[t for t in customer.transactions.limit(100)])
+                           customer=customer,
+                           transactions=Customer.list_transactions(self.seller_db, customer.id))
+
+
+class QrCodeHandler(PageHandler):
+    """会员卡二维码, 卡号不会改变, 浏览器可以长期缓存
+    """
+    _card_pattern = re.compile('^[0-9a-z]{1,32}$')
+    access_log_sample_rate = 0.01
+
+    @require_login
+    def get(self, *args, **kwargs):
+        card = self.get_str_argument('card')
+        if not self._card_pattern.match(card):
+            raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', 'image/svg+xml')
+        self.set_header('Cache-Control', 'private, max-age=31536000, immutable')
+        return self.finish(render_qr_svg(card))
+
+
+class SyncHandler(ApiHandler):
+    """增量同步会员和充值规则, 收银终端据此在本地保存一份副本
+
+    游标记录上次同步到的更新时间和ID, 返回的more为真时应立即用新游标继续同步. 只返回sync_settle_time秒之前
+    更新的记录, 避免漏掉更新时间较早但提交较晚的记录.
+    """
+    _time_format = '%Y-%m-%d %H:%M:%S.%f'
+    access_log_sample_rate = 0.1
+
+    @require_login
+    def get(self, *args, **kwargs):
+        try:
+            cursor = self.parse_cursor(self.get_str_argument('cursor'))
+        except:
+            return self.api_failed(1, 'Invalid cursor.')
+        seller_id = self.current_user.sellerId
+        before_time = datetime.now() - timedelta(seconds=options.sync_settle_time)
+        customers = Customer.list_changes(self.seller_db, seller_id, *cursor['customers'], before_time=before_time,
+                                          limit=options.sync_batch_size)
+        charge_rules = ChargeRule.list_changes(self.seller_db, seller_id, *cursor['chargeRules'],
+                                               before_time=before_time, limit=options.sync_batch_size)
+        if customers:
+            cursor['customers'] = (customers[-1].updateTime, customers[-1].id)
+        if charge_rules:
+            cursor['chargeRules'] = (charge_rules[-1].updateTime, charge_rules[-1].id)
+        return self.api_succeed({
+            'customers': [dict(c._asdict(), updateTime=c.updateTime.timestamp()) for c in customers],
+            'chargeRules': [dict(r._asdict(), updateTime=r.updateTime.timestamp()) for r in charge_rules],
+            'cursor': self.format_cursor(cursor),
+            'more': len(customers) == options.sync_batch_size or len(charge_rules) == options.sync_batch_size
+        })
+
+    def parse_cursor(self, raw_cursor):
+        cursor = json.loads(urlsafe_b64decode(raw_cursor.encode('ascii')).decode('utf-8')) if raw_cursor else {}
+        return {key: (datetime.strptime(cursor[key][0], self._time_format), int(cursor[key][1])) if key in cursor
+                else (datetime(1970, 1, 1), 0)
+                for key in ('customers', 'chargeRules')}
+
+    def format_cursor(self, cursor):
+        cursor = {key: (update_time.strftime(self._time_format), id) for key, (update_time, id) in cursor.items()}
+        return urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('ascii')
+
+
+class LiveHandler(SocketHandler):
+    """推送本商户会员的变更, 页面据此更新余额, 无需刷新
+    """
+    @require_login
+    def get(self, *args, **kwargs):
+        return super().get(*args, **kwargs)
+
+    def open(self, *args, **kwargs):
+        self.channel = Seller.live_channel(self.current_user.sellerId)
+        live.subscribe(self.channel, self.write_message)
+
+    def on_close(self):
+        live.unsubscribe(self.channel, self.write_message)
 
 
 class DownloadCustomerDetailHandler(PageHandler):
     """下载会员充值和消费的历史记录
     """
+    rate_limits = (('seller', 2, 10),)
+
     @require_login
     def get(self, *args, **kwargs):
         id = self.get_int_argument('id')
-        customer = Customer.get(self.db, self.current_user.sellerId, id=id)
+        customer = Customer.get(self.seller_db, self.current_user.sellerId, id=id)
         self.set_header('Content-Type', 'application/octet-stream')
         self.set_header('Content-Disposition:', 'attachment;filename={0}-{1}.csv'
                         .format(customer.name, customer.cellphone[3:]))
@@ -183,7 +363,7 @@ class DownloadCustomerDetailHandler(PageHandler):
         self.write('"身份证","{0}",\n'.format(customer.identification))
         self.write('"手机","{0}",\n'.format(customer.cellphone))
         self.write('"时间","类别","余额变动","次数变动","积分变动","剩余金额","剩余次数","剩余积分","备注"\n')
-        for t in customer.transactions.limit(100):
+        for t in Customer.list_transactions(self.seller_db, customer.id):
             self.write('"{0}","{1}","{2}","{3}","{4}","{5}","{6}","{7}","{8}"\n'.
                        format(datetime.strftime(t.createTime, '%Y-%m-%d %H:%M'), {1: '充值', 5: '消费'}[t.kind],
                               t.balanceChange, t.quantityChange, t.scoreChange, t.balance, t.quantity, t.score,
@@ -194,11 +374,17 @@ class DownloadCustomerDetailHandler(PageHandler):
 class SellerTransactionsHandler(PageHandler):
     """商户所有会员的充值和消费记录
     """
+    rate_limits = (('seller', 2, 10),)
+
     @require_login
     def get(self, *args, **kwargs):
         page_num = self.get_int_argument('page')
-        transactions, page_num, page_count = Seller.list_transactions_by_page(self.db, self.current_user.sellerId,
-                                                                              page_num)
+        version = Seller.get_data_version(self.current_user.sellerId)
+        if self.check_not_modified('sellerTransactions:{0}:{1}'.format(version, page_num)
+                                  if version is not None else None):
+            return
+        transactions, page_num, page_count = Seller.list_transactions_by_page(self.seller_db,
+                                                                              self.current_user.sellerId, page_num)
         return self.render('urvip/seller_transactions.html',
                            user_name=self.current_user.cellphone,
                            transactions=transactions, page_num=page_num, page_count=page_count)
@@ -212,11 +398,15 @@ __handlers__ = [
     (r'^/deleteChargeRule$', DeleteChargeRuleHandler),
     (r'^/customers$', CustomersHandler),
     (r'^/addCustomer$', AddCustomerHandler),
+    (r'^/importCustomers$', ImportCustomersHandler),
     (r'^/deleteCustomer$', DeleteCustomerHandler),
     (r'^/charge$', ChargeHandler),
     (r'^/sendConsumeCaptcha', SendConsumeCaptchaHandler),
     (r'^/consume$', ConsumeHandler),
     (r'^/customerDetail$', CustomerDetailHandler),
+    (r'^/qrCode$', QrCodeHandler),
+    (r'^/sync$', SyncHandler),
+    (r'^/live$', LiveHandler),
     (r'^/downloadCustomerDetail$', DownloadCustomerDetailHandler),
     (r'^/sellerTransactions$', SellerTransactionsHandler)
 ]
@@ -1,19 +1,48 @@
+from collections import namedtuple
 from datetime import datetime
 from random import random
 from uuid import uuid4
+import csv
+import logging
+import os
+import re
 
-from sqlalchemy import Column, BigInteger, Integer, String, Float, DateTime, ForeignKey
+from sqlalchemy import Column, Index, Table, MetaData, BigInteger, Integer, String, Float, DateTime, ForeignKey, func, \
+    and_, bindparam
 from sqlalchemy.orm import relationship
+from sqlalchemy.orm.exc import NoResultFound
 
-from core.models import BaseModel, paginate
+from core import feed, live
+from core.caches import get_version, bump_version, revoke_sessions
+from core.models import BaseModel, IdType, TimeType, UpdateConflictError, projection, paginate, seek, shard_count, \
+    place_seller, set_seller_shard, seller_database
 from core.utils.sms import send_sms
 
 
+# 列表页面只读取渲染需要的字段
+ChargeRuleRow = namedtuple('ChargeRuleRow', ['id', 'name', 'payout', 'balanceChange', 'quantityChange',
+                                             'scoreChange'])
+CustomerRow = namedtuple('CustomerRow', ['id', 'name', 'gender', 'identification', 'cellphone',
+                                         'balance', 'quantity', 'score', 'updateTime'])
+CustomerValidatorRow = namedtuple('CustomerValidatorRow', ['id', 'updateTime'])
+CustomerSummaryRow = namedtuple('CustomerSummaryRow', ['name', 'gender', 'identification', 'cellphone'])
+TransactionRow = namedtuple('TransactionRow', ['id', 'kind', 'balanceChange', 'balance', 'quantityChange',
+                                               'quantity', 'scoreChange', 'score', 'comments', 'createTime'])
+SellerTransactionRow = namedtuple('SellerTransactionRow', TransactionRow._fields + ('customer',))
+# 同步接口还需要状态, 已删除的记录也要同步
+ChargeRuleSyncRow = namedtuple('ChargeRuleSyncRow', ChargeRuleRow._fields + ('status', 'updateTime'))
+CustomerSyncRow = namedtuple('CustomerSyncRow', CustomerRow._fields + ('card', 'level', 'status'))
+# 合并提交的充值、消费操作, kind与Transaction.kind相同, 充值用chargeRuleId, 消费用其余参数
+LedgerOperation = namedtuple('LedgerOperation', ['kind', 'sellerId', 'customerId', 'oldUpdateTime', 'chargeRuleId',
+                                                 'balanceChange', 'quantityChange', 'scoreChange', 'comments',
+                                                 'captcha'])
+
+
 class Seller(BaseModel):
     """商户
     """
     __tablename__ = 'seller'
-    id = Column('id', BigInteger, primary_key=True)
+    id = Column('id', IdType, primary_key=True)
     name = Column('name', String(40))
     weChatAccount = Column('we_chat_account', String(40))
     identificationKind = Column('identification_kind', Integer)
@@ -37,41 +66,123 @@ class Seller(BaseModel):
                         status=1, createTime=now, updateTime=now)
         db.add(seller)
         db.commit()
+        if shard_count():
+            # 分库时商户记录同时复制到所在的分库, 会员和充值规则的外键和seller关系依赖这份复制
+            set_seller_shard(seller.id, place_seller(seller.id))
+            Seller._copy_to_shard(seller)
         return seller
 
     @staticmethod
-    def delete(db, seller_id):
-        """删除商户
+    def delete(db, seller_id, batch_size=1000):
+        """删除商户, 同时删除其管理员、会员和充值规则, 并注销管理员的所有会话
+
+        会员和充值规则每次更新batch_size条并提交, 避免长事务锁住大量记录.
         """
         now = datetime.now()
         seller = db.query(Seller).filter(Seller.id == seller_id).one()
-        for admin in seller.admins:
-            admin.status = 9
-            admin.updateTime = now
-            db.merge(admin)
+        admin_ids = [a.id for a in db.query(Admin.id).filter(Admin.sellerId == seller_id)]
+        db.query(Admin).filter(Admin.sellerId == seller_id, Admin.status != 9)\
+          .update({'status': 9, 'updateTime': now}, synchronize_session=False)
         seller.status = 9
         seller.updateTime = now
         db.merge(seller)
         db.commit()
+        if shard_count():
+            Seller._copy_to_shard(seller)
+        shard_db = seller_database(seller_id)
+        for model in (ChargeRule, Customer):
+            while True:
+                ids = [r.id for r in shard_db.query(model.id)
+                                             .filter(model.sellerId == seller_id, model.status == 1)
+                                             .limit(batch_size)]
+                if not ids:
+                    break
+                shard_db.query(model).filter(model.id.in_(ids))\
+                        .update({'status': 9, 'updateTime': now}, synchronize_session=False)
+                shard_db.commit()
+        event = feed.record(shard_db, {'type': 'sellerDeleted', 'sellerId': seller_id})
+        shard_db.commit()
+        feed.publish(shard_db, event)
+        Seller.bump_data_version(seller_id)
+        # 数据已全部删除后再注销会话, 会话存储不可用时只记录日志, 未注销的会话等过期
+        try:
+            revoke_sessions(admin_ids)
+        except:
+            logging.warning('Failed to revoke sessions of seller {0}.'.format(seller_id))
+
+    @staticmethod
+    def _copy_to_shard(seller):
+        shard_db = seller_database(seller.id)
+        shard_db.merge(Seller(id=seller.id, name=seller.name, weChatAccount=seller.weChatAccount,
+                              identificationKind=seller.identificationKind, identification=seller.identification,
+                              address=seller.address, zipCode=seller.zipCode, scoreRate=seller.scoreRate,
+                              status=seller.status, createTime=seller.createTime, updateTime=seller.updateTime))
+        shard_db.commit()
+
+    @staticmethod
+    def get_data_version(seller_id):
+        """商户会员和充值规则数据的版本号, 缓存不可用时为None
+        """
+        return get_version('version:seller:{0}'.format(seller_id))
+
+    @staticmethod
+    def bump_data_version(seller_id):
+        """会员或充值规则变动后更新版本号, 使缓存的页面片段失效
+        """
+        bump_version('version:seller:{0}'.format(seller_id))
+
+    @staticmethod
+    def live_channel(seller_id):
+        """推送商户会员变更的频道
+        """
+        return 'seller:{0}'.format(seller_id)
 
     @staticmethod
     def list_transactions_by_page(db, seller_id, page_num, page_size=10):
         """商户所有会员的充值和消费记录
         """
-        cursor = db.query(Transaction).join(Transaction.customer)\
-                   .filter(Customer.sellerId == seller_id)\
+        cursor = db.query(*projection(Transaction, TransactionRow), *projection(Customer, CustomerSummaryRow))\
+                   .join(Transaction.customer)\
+                   .filter(Transaction.sellerId == seller_id)\
                    .order_by(Transaction.createTime.desc())
-        total_count = cursor.count()
-        page_num, page_count = paginate(total_count, page_num, page_size)
-        transactions = cursor.offset(page_num * page_size).limit(page_size)
-        return [t for t in transactions], page_num, page_count
+        hot_count = db.query(func.count(Transaction.id)).filter(Transaction.sellerId == seller_id).scalar()
+        archives = db.query(TransactionArchive.month, TransactionArchive.count)\
+                     .filter(TransactionArchive.sellerId == seller_id, TransactionArchive.count > 0)\
+                     .order_by(TransactionArchive.month.desc()).all()
+        page_num, page_count = paginate(hot_count + sum(a.count for a in archives), page_num, page_size)
+        offset, limit = page_num * page_size, page_size
+        size = len(TransactionRow._fields)
+        transactions = []
+        # 先读未归档的记录, 翻页超过后再按月份从新到旧读归档表
+        if offset < hot_count:
+            transactions.extend(cursor.offset(offset).limit(limit))
+            offset, limit = 0, limit - len(transactions)
+        else:
+            offset -= hot_count
+        for archive in archives:
+            if limit <= 0:
+                break
+            if offset >= archive.count:
+                offset -= archive.count
+                continue
+            table = Transaction.archive_table(archive.month)
+            archived = db.query(*Transaction.archive_columns(table), *projection(Customer, CustomerSummaryRow))\
+                         .select_from(table)\
+                         .join(Customer, Customer.id == table.c.customer_id)\
+                         .filter(table.c.seller_id == seller_id)\
+                         .order_by(table.c.create_time.desc())\
+                         .offset(offset).limit(limit).all()
+            transactions.extend(archived)
+            offset, limit = 0, limit - len(archived)
+        return [SellerTransactionRow(*t[:size], customer=CustomerSummaryRow(*t[size:])) for t in transactions], \
+            page_num, page_count
 
 
 class Admin(BaseModel):
     """商户管理员
     """
     __tablename__ = 'admin'
-    id = Column('id', BigInteger, primary_key=True)
+    id = Column('id', IdType, primary_key=True)
     sellerId = Column('seller_id', BigInteger, ForeignKey('seller.id'))
     seller = relationship('Seller', foreign_keys=sellerId, back_populates='admins')
     cellphone = Column('cellphone', String(20), unique=True)
@@ -126,7 +237,9 @@ class ChargeRule(BaseModel):
     """商户充值规则
     """
     __tablename__ = 'charge_rule'
-    id = Column('id', BigInteger, primary_key=True)
+    __table_args__ = (Index('ix_charge_rule_seller_id_status', 'seller_id', 'status'),
+                      Index('ix_charge_rule_seller_id_update_time', 'seller_id', 'update_time'))
+    id = Column('id', IdType, primary_key=True)
     sellerId = Column('seller_id', BigInteger, ForeignKey('seller.id'))
     seller = relationship('Seller', foreign_keys=sellerId, back_populates='chargeRules')
     name = Column('name', String(20))
@@ -136,14 +249,24 @@ class ChargeRule(BaseModel):
     scoreChange = Column('score_change', Integer)
     status = Column('status', Integer)
     createTime = Column('create_time', DateTime)
-    updateTime = Column('update_time', DateTime)
+    updateTime = Column('update_time', TimeType)
 
     @staticmethod
     def list(db, seller_id):
         """充值规则列表
         """
-        charge_rules = db.query(ChargeRule).filter(ChargeRule.sellerId == seller_id, ChargeRule.status == 1)
-        return [r for r in charge_rules]
+        charge_rules = db.query(*projection(ChargeRule, ChargeRuleRow))\
+                         .filter(ChargeRule.sellerId == seller_id, ChargeRule.status == 1)
+        return [ChargeRuleRow(*r) for r in charge_rules]
+
+    @staticmethod
+    def list_changes(db, seller_id, after_time, after_id, before_time, limit=500):
+        """更新时间和ID在(after_time, after_id)之后, 更新时间早于before_time的充值规则, 包括已删除的
+        """
+        cursor = db.query(*projection(ChargeRule, ChargeRuleSyncRow))\
+                   .filter(ChargeRule.sellerId == seller_id, ChargeRule.updateTime < before_time)
+        return [ChargeRuleSyncRow(*r) for r in seek(cursor, ChargeRule.updateTime, ChargeRule.id,
+                                                    after_time, after_id).limit(limit)]
 
     @staticmethod
     def add(db, seller_id, name, payout, balance_change, quantity_change, score_change):
@@ -155,6 +278,7 @@ class ChargeRule(BaseModel):
                                  createTime=now, updateTime=now)
         db.add(charge_rule)
         db.commit()
+        Seller.bump_data_version(seller_id)
         return charge_rule
 
     @staticmethod
@@ -168,15 +292,20 @@ class ChargeRule(BaseModel):
         charge_rule.updateTime = now
         db.merge(charge_rule)
         db.commit()
+        Seller.bump_data_version(seller_id)
 
 
 class Transaction(BaseModel):
     """会员充值、消费记录
     """
     __tablename__ = 'transaction'
-    id = Column('id', BigInteger, primary_key=True)
+    __table_args__ = (Index('ix_transaction_customer_id_create_time', 'customer_id', 'create_time'),
+                      Index('ix_transaction_seller_id_create_time', 'seller_id', 'create_time'))
+    id = Column('id', IdType, primary_key=True)
     customerId = Column('customer_id', BigInteger, ForeignKey('customer.id'))
     customer = relationship('Customer', foreign_keys=customerId, back_populates='transactions')
+    # 冗余会员的商户ID, 商户交易记录按索引(seller_id, create_time)分页
+    sellerId = Column('seller_id', BigInteger, ForeignKey('seller.id'), nullable=False)
     kind = Column('kind', Integer)
     balanceChange = Column('balance_change', Float)
     balance = Column('balance', Float)
@@ -187,12 +316,105 @@ class Transaction(BaseModel):
     comments = Column('comments', String(120))
     createTime = Column('create_time', DateTime)
 
+    _archive_metadata = MetaData()
+
+    @staticmethod
+    def archive_table(month):
+        """归档表, 每月一张, month如201701
+        """
+        name = 'transaction_{0}'.format(month)
+        if name not in Transaction._archive_metadata.tables:
+            Table(name, Transaction._archive_metadata,
+                  *[Column(c.name, c.type, primary_key=c.primary_key, autoincrement=False)
+                    for c in Transaction.__table__.columns],
+                  Index('ix_{0}_customer_id_create_time'.format(name), 'customer_id', 'create_time'),
+                  Index('ix_{0}_seller_id_create_time'.format(name), 'seller_id', 'create_time'))
+        return Transaction._archive_metadata.tables[name]
+
+    @staticmethod
+    def archive_columns(table):
+        """归档表中与TransactionRow字段对应的列
+        """
+        return [table.c[getattr(Transaction, field).property.columns[0].name].label(field)
+                for field in TransactionRow._fields]
+
+    @staticmethod
+    def archive(db, before, batch_size=1000):
+        """将早于before的一批记录移到归档表, 返回移动的记录数, 每批一个事务
+        """
+        # 商户ID为空的记录无法归档, 留在原表
+        transactions = db.query(Transaction).filter(Transaction.createTime < before, Transaction.sellerId.isnot(None))\
+                         .order_by(Transaction.id).limit(batch_size).all()
+        if not transactions:
+            return 0
+        columns = [(a.key, a.columns[0].name) for a in Transaction.__mapper__.column_attrs]
+        months = dict()
+        for t in transactions:
+            month = t.createTime.year * 100 + t.createTime.month
+            months.setdefault(month, []).append({name: getattr(t, key) for key, name in columns})
+        # MySQL执行DDL时会隐式提交, 归档表用另一个连接在本批事务之外创建
+        for month in months:
+            Transaction.archive_table(month).create(bind=db.get_bind(), checkfirst=True)
+        for month, rows in months.items():
+            db.execute(Transaction.archive_table(month).insert(), rows)
+            Transaction._count_archived(db, TransactionArchive, TransactionArchive.sellerId, month,
+                                        [(row['seller_id'], row['seller_id']) for row in rows])
+            Transaction._count_archived(db, CustomerArchive, CustomerArchive.customerId, month,
+                                        [(row['customer_id'], row['seller_id']) for row in rows])
+        db.query(Transaction).filter(Transaction.id.in_([t.id for t in transactions]))\
+          .delete(synchronize_session=False)
+        db.commit()
+        return len(transactions)
+
+    @staticmethod
+    def _count_archived(db, model, key_column, month, keys):
+        """累加归档计数, keys为每条记录的(键, 商户ID)
+        """
+        counts, seller_ids = dict(), dict()
+        for key, seller_id in keys:
+            counts[key] = counts.get(key, 0) + 1
+            seller_ids[key] = seller_id
+        archives = {getattr(a, key_column.key): a for a in db.query(model)
+                                                           .filter(key_column.in_(list(counts)), model.month == month)
+                                                           .with_lockmode('update')}
+        for key, count in counts.items():
+            if key in archives:
+                archives[key].count += count
+            else:
+                archive = model(month=month, sellerId=seller_ids[key], count=count)
+                setattr(archive, key_column.key, key)
+                db.add(archive)
+
+
+class TransactionArchive(BaseModel):
+    """商户每月归档的充值、消费记录数, 分页时据此跳过整月的归档表
+    """
+    __tablename__ = 'transaction_archive'
+    sellerId = Column('seller_id', BigInteger, primary_key=True, autoincrement=False)
+    month = Column('month', Integer, primary_key=True, autoincrement=False)
+    count = Column('count', BigInteger)
+
+
+class CustomerArchive(BaseModel):
+    """会员每月归档的充值、消费记录数, 会员的记录只读有归档的月份
+    """
+    __tablename__ = 'customer_archive'
+    __table_args__ = (Index('ix_customer_archive_customer_id_month', 'customer_id', 'month', unique=True),)
+    id = Column('id', IdType, primary_key=True)
+    customerId = Column('customer_id', BigInteger)
+    month = Column('month', Integer)
+    # 冗余会员的商户ID, 迁移商户时据此复制
+    sellerId = Column('seller_id', BigInteger, index=True)
+    count = Column('count', BigInteger)
+
 
 class Customer(BaseModel):
     """会员
     """
     __tablename__ = 'customer'
-    id = Column('id', BigInteger, primary_key=True)
+    __table_args__ = (Index('ix_customer_seller_id_status_update_time', 'seller_id', 'status', 'update_time'),
+                      Index('ix_customer_seller_id_update_time', 'seller_id', 'update_time'))
+    id = Column('id', IdType, primary_key=True)
     sellerId = Column('seller_id', BigInteger, ForeignKey('seller.id'))
     seller = relationship('Seller', foreign_keys=sellerId, back_populates='customers')
     identification = Column('identification', String(20))
@@ -215,24 +437,31 @@ class Customer(BaseModel):
                                 back_populates='customer', lazy='dynamic')
     status = Column('status', Integer)
     createTime = Column('create_time', DateTime)
-    updateTime = Column('update_time', DateTime)
+    updateTime = Column('update_time', TimeType)
 
     @staticmethod
     def get(db, seller_id, id=None, card=None, cellphone=None):
         """查找会员
         """
+        return Customer._filter_by_key(db.query(Customer), seller_id, id, card, cellphone).first()
+
+    @staticmethod
+    def get_validator(db, seller_id, id=None, card=None, cellphone=None):
+        """查找会员的ID和更新时间, 充值和消费都会更新updateTime, 可用于判断会员详情页面是否变化
+        """
+        validator = Customer._filter_by_key(db.query(*projection(Customer, CustomerValidatorRow)),
+                                            seller_id, id, card, cellphone).first()
+        return CustomerValidatorRow(*validator) if validator else None
+
+    @staticmethod
+    def _filter_by_key(cursor, seller_id, id=None, card=None, cellphone=None):
         if id:
-            return db.query(Customer).filter(Customer.id == id,
-                                             Customer.sellerId == seller_id,
-                                             Customer.status == 1).first()
+            return cursor.filter(Customer.id == id, Customer.sellerId == seller_id, Customer.status == 1)
         elif card:
-            return db.query(Customer).filter(Customer.card == card,
-                                             Customer.sellerId == seller_id,
-                                             Customer.status == 1).first()
+            return cursor.filter(Customer.card == card, Customer.sellerId == seller_id, Customer.status == 1)
         elif cellphone:
-            return db.query(Customer).filter(Customer.cellphone == cellphone,
-                                             Customer.sellerId == seller_id,
-                                             Customer.status == 1).first()
+            return cursor.filter(Customer.cellphone == cellphone, Customer.sellerId == seller_id,
+                                 Customer.status == 1)
         else:
             raise Exception
 
@@ -240,13 +469,46 @@ class Customer(BaseModel):
     def list_by_page(db, seller_id, page_num, page_size=10):
         """会员分页列表
         """
-        cursor = db.query(Customer)\
+        cursor = db.query(*projection(Customer, CustomerRow))\
                    .filter(Customer.sellerId == seller_id, Customer.status == 1)\
                    .order_by(Customer.updateTime.desc())
-        total_count = cursor.count()
+        total_count = db.query(func.count(Customer.id))\
+                        .filter(Customer.sellerId == seller_id, Customer.status == 1).scalar()
         page_num, page_count = paginate(total_count, page_num, page_size)
         customers = cursor.offset(page_num * page_size).limit(page_size)
-        return [c for c in customers], page_num, page_count
+        return [CustomerRow(*c) for c in customers], page_num, page_count
+
+    @staticmethod
+    def list_changes(db, seller_id, after_time, after_id, before_time, limit=500):
+        """更新时间和ID在(after_time, after_id)之后, 更新时间早于before_time的会员, 包括已删除的
+        """
+        cursor = db.query(*projection(Customer, CustomerSyncRow))\
+                   .filter(Customer.sellerId == seller_id, Customer.updateTime < before_time)
+        return [CustomerSyncRow(*c) for c in seek(cursor, Customer.updateTime, Customer.id,
+                                                  after_time, after_id).limit(limit)]
+
+    @staticmethod
+    def list_transactions(db, customer_id, limit=100):
+        """会员最近的充值和消费记录
+        """
+        transactions = db.query(*projection(Transaction, TransactionRow))\
+                         .filter(Transaction.customerId == customer_id)\
+                         .order_by(Transaction.createTime.desc())\
+                         .limit(limit).all()
+        # 未归档的记录不够时才读归档表, 只读该会员有记录的月份
+        if len(transactions) < limit:
+            months = db.query(CustomerArchive.month)\
+                       .filter(CustomerArchive.customerId == customer_id, CustomerArchive.count > 0)\
+                       .order_by(CustomerArchive.month.desc())
+            for month in [m.month for m in months]:
+                table = Transaction.archive_table(month)
+                transactions.extend(db.query(*Transaction.archive_columns(table))
+                                      .filter(table.c.customer_id == customer_id)
+                                      .order_by(table.c.create_time.desc())
+                                      .limit(limit - len(transactions)))
+                if len(transactions) >= limit:
+                    break
+        return [TransactionRow(*t) for t in transactions]
 
     @staticmethod
     def add(db, seller_id, identification, name, gender, cellphone):
@@ -258,9 +520,126 @@ class Customer(BaseModel):
                             address='', zipCode='', balance=0, quantity=0, score=0, level=1, status=1,
                             createTime=now, updateTime=now)
         db.add(customer)
+        db.flush()
+        change = Customer._event('added', customer)
+        event = feed.record(db, change)
         db.commit()
+        feed.publish(db, event)
+        Seller.bump_data_version(seller_id)
+        live.publish(Seller.live_channel(seller_id), dict(change, updateTime=now.timestamp()))
         return customer
 
+    # 导入文件第一行的列名, 中文列名与下载的CSV一致
+    _import_columns = {'name': 'name', '姓名': 'name', 'gender': 'gender', '性别': 'gender',
+                       'identification': 'identification', '身份证': 'identification', '身份证号': 'identification',
+                       'cellphone': 'cellphone', '手机': 'cellphone', '手机号': 'cellphone'}
+    _import_genders = {'1': 1, '2': 2, '男': 1, '女': 2}
+    _cellphone_pattern = re.compile('^(\\+86)?([0-9]{11})$')
+    _identification_pattern = re.compile('^[0-9]{17}[0-9X]$')
+
+    @staticmethod
+    def import_csv(db, seller_id, lines, batch_size=1000, on_progress=None, max_errors=1000):
+        """从CSV批量导入会员, 返回导入的会员数和出错的行号及原因
+
+        每批提交后调用on_progress(已导入数, 出错数).
+        """
+        imported, errors = 0, []
+        for imported, errors in Customer.import_batches(db, seller_id, lines, batch_size, max_errors):
+            if on_progress:
+                on_progress(imported, len(errors))
+        return imported, errors
+
+    @staticmethod
+    def import_batches(db, seller_id, lines, batch_size=1000, max_errors=1000):
+        """逐批从CSV导入会员, 每批提交后返回已导入的会员数和出错的行号及原因
+
+        逐行解析, 每batch_size个会员一次批量插入并提交, 调用方可在两批之间处理其他请求.
+        手机号与本商户已有的或文件中前面的会员重复的行不导入. 进度推送到商户的实时频道.
+        """
+        reader = csv.reader(lines)
+        fields = [Customer._import_columns.get(name.strip()) for name in next(reader, [])]
+        missing = {'name', 'gender', 'cellphone'} - set(fields)
+        if missing:
+            yield 0, [(1, 'Missing columns {0}.'.format(', '.join(sorted(missing))))]
+            return
+        cellphones = {c.cellphone for c in db.query(Customer.cellphone)
+                                              .filter(Customer.sellerId == seller_id, Customer.status == 1)}
+        imported, errors, batch = 0, [], []
+        for values in reader:
+            if not any(values):
+                continue
+            row = {field: value.strip() for field, value in zip(fields, values) if field}
+            customer, error = Customer._validate_import_row(row, cellphones)
+            if error:
+                errors.append((reader.line_num, error))
+                if len(errors) >= max_errors:
+                    break
+                continue
+            cellphones.add(customer['cellphone'])
+            batch.append(customer)
+            if len(batch) >= batch_size:
+                imported += Customer._insert_imported(db, seller_id, batch, imported, len(errors))
+                batch = []
+                yield imported, errors
+        if batch:
+            imported += Customer._insert_imported(db, seller_id, batch, imported, len(errors))
+        yield imported, errors
+
+    @staticmethod
+    def _validate_import_row(row, cellphones):
+        name = row.get('name', '')
+        gender = Customer._import_genders.get(row.get('gender', ''))
+        identification = row.get('identification', '').upper()
+        match = Customer._cellphone_pattern.match(row.get('cellphone', ''))
+        if not name or len(name) > 20:
+            return None, 'Invalid name.'
+        if not gender:
+            return None, 'Invalid gender.'
+        if identification and not Customer._identification_pattern.match(identification):
+            return None, 'Invalid identification.'
+        if not match:
+            return None, 'Invalid cellphone.'
+        cellphone = '+86' + match.group(2)
+        if cellphone in cellphones:
+            return None, 'Duplicate cellphone.'
+        return {'name': name, 'gender': gender, 'identification': identification, 'cellphone': cellphone}, None
+
+    @staticmethod
+    def _insert_imported(db, seller_id, batch, imported, failed):
+        now = datetime.now()
+        # 一次读取整批会员卡号的随机数
+        cards = os.urandom(16 * len(batch)).hex()
+        cards = [cards[i * 32:(i + 1) * 32] for i in range(len(batch))]
+        db.execute(Customer.__table__.insert(), [
+            {'seller_id': seller_id, 'identification': c['identification'], 'name': c['name'], 'gender': c['gender'],
+             'cellphone': c['cellphone'], 'we_chat_open_id': '', 'card': cards[i], 'address': '',
+             'zip_code': '', 'balance': 0, 'quantity': 0, 'score': 0, 'level': 1, 'status': 1,
+             'create_time': now, 'update_time': now}
+            for i, c in enumerate(batch)])
+        # 多行插入得不到各行的ID, 按唯一的卡号查回, 并发插入时ID不一定连续, 事件中记录若干连续区间
+        ids = sorted(c.id for c in db.query(Customer.id).filter(Customer.card.in_(cards)))
+        event = feed.record(db, {'type': 'imported', 'sellerId': seller_id, 'count': len(batch),
+                                 'customerIdRanges': Customer._id_ranges(ids)})
+        db.commit()
+        feed.publish(db, event)
+        Seller.bump_data_version(seller_id)
+        live.publish(Seller.live_channel(seller_id), {'type': 'importing', 'sellerId': seller_id,
+                                                      'imported': imported + len(batch), 'errors': failed,
+                                                      'updateTime': now.timestamp()})
+        return len(batch)
+
+    @staticmethod
+    def _id_ranges(ids):
+        """有序ID合并为[首, 尾]区间的列表
+        """
+        ranges = []
+        for id in ids:
+            if ranges and ranges[-1][1] == id - 1:
+                ranges[-1][1] = id
+            else:
+                ranges.append([id, id])
+        return ranges
+
     @staticmethod
     def delete(db, seller_id, customer_id):
         """删除会员
@@ -271,29 +650,29 @@ class Customer(BaseModel):
         customer.status = 9
         customer.updateTime = now
         db.merge(customer)
+        change = Customer._event('deleted', customer)
+        event = feed.record(db, change)
         db.commit()
+        feed.publish(db, event)
+        Seller.bump_data_version(seller_id)
+        live.publish(Seller.live_channel(seller_id), dict(change, updateTime=now.timestamp()))
 
     @staticmethod
     def charge(db, seller_id, customer_id, old_update_time, charge_rule_id, comments):
-        """会员充值
+        """会员充值, 会员不存在或已被修改时抛出UpdateConflictError
         """
         now = datetime.now()
         customer = db.query(Customer).filter(Customer.id == customer_id,
                                              Customer.updateTime == datetime.fromtimestamp(old_update_time),
                                              Customer.sellerId == seller_id,
-                                             Customer.status == 1).one()
+                                             Customer.status == 1).first()
+        if customer is None:
+            raise UpdateConflictError()
         charge_rule = db.query(ChargeRule).filter(ChargeRule.id == charge_rule_id,
                                                   ChargeRule.sellerId == seller_id,
                                                   ChargeRule.status == 1).one()
-        balance = customer.balance + charge_rule.balanceChange
-        quantity = customer.quantity + charge_rule.quantityChange
-        score = customer.score + charge_rule.scoreChange
         # 写充值记录
-        transaction = Transaction(customerId=customer.id, kind=1,
-                                  balanceChange=charge_rule.balanceChange, balance=balance,
-                                  quantityChange=charge_rule.quantityChange, quantity=quantity,
-                                  scoreChange=charge_rule.scoreChange, score=score,
-                                  comments=comments, createTime=now)
+        transaction = Customer._charge_transaction(customer, charge_rule, comments, now)
         db.add(transaction)
         # 为帐号充值
         if db.query(Customer)\
@@ -301,12 +680,42 @@ class Customer(BaseModel):
                         Customer.status == 1,
                         Customer.updateTime == datetime.fromtimestamp(old_update_time))\
                 .with_lockmode('update')\
-                .update({'balance': balance, 'quantity': quantity, 'score': score, 'updateTime': now}):
+                .update({'balance': transaction.balance, 'quantity': transaction.quantity,
+                         'score': transaction.score, 'updateTime': now}):
+            change = Customer._event('charged', customer, transaction)
+            event = feed.record(db, change)
             db.commit()
+            feed.publish(db, event)
+            Seller.bump_data_version(seller_id)
+            live.publish(Seller.live_channel(seller_id), dict(change, updateTime=now.timestamp(), comments=comments))
         else:
             db.rollback()
+            raise UpdateConflictError()
         return customer
 
+    @staticmethod
+    def _charge_transaction(customer, charge_rule, comments, now):
+        """充值记录, 余额、次数和积分是充值后的值
+        """
+        return Transaction(customerId=customer.id, sellerId=customer.sellerId, kind=1,
+                           balanceChange=charge_rule.balanceChange,
+                           balance=customer.balance + charge_rule.balanceChange,
+                           quantityChange=charge_rule.quantityChange,
+                           quantity=customer.quantity + charge_rule.quantityChange,
+                           scoreChange=charge_rule.scoreChange, score=customer.score + charge_rule.scoreChange,
+                           comments=comments, createTime=now)
+
+    @staticmethod
+    def _event(kind, customer, transaction=None):
+        """变更事件, 充值和消费带上流水和变更后的余额
+        """
+        event = {'type': kind, 'sellerId': customer.sellerId, 'customerId': customer.id}
+        if transaction:
+            event.update(transactionId=transaction.id, balanceChange=transaction.balanceChange,
+                         balance=transaction.balance, quantityChange=transaction.quantityChange,
+                         quantity=transaction.quantity, scoreChange=transaction.scoreChange, score=transaction.score)
+        return event
+
     @staticmethod
     def send_consume_captcha(db, seller_id, customer_id, cellphone, old_update_time):
         """发送消费验证码
@@ -331,34 +740,18 @@ class Customer(BaseModel):
     @staticmethod
     def consume(db, seller_id, customer_id, old_update_time,
                 balance_change=0, quantity_change=0, score_change=0, comments=None, captcha=None):
-        """会员消费
+        """会员消费, 会员不存在或已被修改时抛出UpdateConflictError
         """
-        if balance_change > 0 or quantity_change > 0 or score_change > 0:
-            raise Exception
-        if balance_change == 0 and quantity_change == 0 and score_change == 0:
-            raise Exception
         now = datetime.now()
         customer = db.query(Customer).filter(Customer.id == customer_id,
                                              Customer.sellerId == seller_id,
                                              Customer.status == 1,
-                                             Customer.updateTime == datetime.fromtimestamp(old_update_time)).one()
-        if captcha and (not customer.cellphoneConsumeCaptcha or
-                        not customer.cellphoneConsumeCaptchaExpireTime or
-                        captcha != customer.cellphoneConsumeCaptcha or
-                        customer.cellphoneConsumeCaptchaExpireTime < now):
-            raise Exception
-        balance = customer.balance + balance_change
-        quantity = customer.quantity + quantity_change
-        score_change += -balance_change * customer.seller.scoreRate
-        score = customer.score + score_change
-        if balance < 0 or quantity < 0 or score < 0:
-            raise Exception
+                                             Customer.updateTime == datetime.fromtimestamp(old_update_time)).first()
+        if customer is None:
+            raise UpdateConflictError()
         # 写消费记录
-        transaction = Transaction(customerId=customer.id, kind=5,
-                                  balanceChange=balance_change, balance=balance,
-                                  quantityChange=quantity_change, quantity=quantity,
-                                  scoreChange=score_change, score=score,
-                                  comments=comments, createTime=now)
+        transaction = Customer._consume_transaction(customer, customer.seller.scoreRate, balance_change,
+                                                    quantity_change, score_change, comments, captcha, now)
         db.add(transaction)
         # 消费
         if db.query(Customer) \
@@ -367,10 +760,160 @@ class Customer(BaseModel):
                         Customer.status == 1,
                         Customer.updateTime == datetime.fromtimestamp(old_update_time)) \
                 .with_lockmode('update') \
-                .update({'balance': balance, 'quantity': quantity, 'score': score,
+                .update({'balance': transaction.balance, 'quantity': transaction.quantity,
+                         'score': transaction.score,
                          'cellphoneConsumeCaptcha': None, 'cellphoneConsumeCaptchaExpireTime': None,
                          'updateTime': now}):
+            change = Customer._event('consumed', customer, transaction)
+            event = feed.record(db, change)
             db.commit()
+            feed.publish(db, event)
+            Seller.bump_data_version(seller_id)
+            live.publish(Seller.live_channel(seller_id), dict(change, updateTime=now.timestamp(), comments=comments))
         else:
             db.rollback()
+            raise UpdateConflictError()
         return
+
+    @staticmethod
+    def _consume_transaction(customer, score_rate, balance_change, quantity_change, score_change, comments, captcha,
+                             now):
+        """消费记录, 变动不是负数, 验证码不对或余额、次数、积分不足时抛出异常
+        """
+        if balance_change > 0 or quantity_change > 0 or score_change > 0:
+            raise Exception
+        if balance_change == 0 and quantity_change == 0 and score_change == 0:
+            raise Exception
+        if captcha and (not customer.cellphoneConsumeCaptcha or
+                        not customer.cellphoneConsumeCaptchaExpireTime or
+                        captcha != customer.cellphoneConsumeCaptcha or
+                        customer.cellphoneConsumeCaptchaExpireTime < now):
+            raise Exception
+        balance = customer.balance + balance_change
+        quantity = customer.quantity + quantity_change
+        score_change += -balance_change * score_rate
+        score = customer.score + score_change
+        if balance < 0 or quantity < 0 or score < 0:
+            raise Exception
+        return Transaction(customerId=customer.id, sellerId=customer.sellerId, kind=5,
+                           balanceChange=balance_change, balance=balance,
+                           quantityChange=quantity_change, quantity=quantity,
+                           scoreChange=score_change, score=score,
+                           comments=comments, createTime=now)
+
+    @staticmethod
+    def apply_ledger(db, operations):
+        """在一个数据库事务中执行多个充值、消费操作, 返回每个操作的结果
+
+        结果为True表示成功, False表示会员不存在或已被修改, 参数不对或余额不足时为异常. 同一会员的后一个操作
+        会因为前一个操作修改了updateTime而冲突, 与逐个执行的结果相同.
+        """
+        now = datetime.now()
+        # 锁住所有会员, 之后的条件更新不会失败
+        customers = {c.id: c for c in db.query(Customer)
+                                        .filter(Customer.id.in_({o.customerId for o in operations}),
+                                                Customer.status == 1)
+                                        .with_lockmode('update')}
+        charge_rule_ids = {o.chargeRuleId for o in operations if o.kind == 1}
+        charge_rules = {r.id: r for r in db.query(ChargeRule).filter(ChargeRule.id.in_(charge_rule_ids),
+                                                                     ChargeRule.status == 1)} \
+            if charge_rule_ids else dict()
+        score_rates = dict(db.query(Seller.id, Seller.scoreRate)
+                             .filter(Seller.id.in_({o.sellerId for o in operations})))
+        results = []
+        applied = []
+        for operation in operations:
+            customer = customers.get(operation.customerId)
+            if customer is None or customer.sellerId != operation.sellerId or \
+                    customer.updateTime != datetime.fromtimestamp(operation.oldUpdateTime):
+                results.append(False)
+                continue
+            try:
+                if operation.kind == 1:
+                    charge_rule = charge_rules.get(operation.chargeRuleId)
+                    if charge_rule is None or charge_rule.sellerId != operation.sellerId:
+                        raise NoResultFound()
+                    transaction = Customer._charge_transaction(customer, charge_rule, operation.comments, now)
+                else:
+                    transaction = Customer._consume_transaction(customer, score_rates[customer.sellerId],
+                                                                operation.balanceChange, operation.quantityChange,
+                                                                operation.scoreChange, operation.comments,
+                                                                operation.captcha, now)
+            except Exception as e:
+                results.append(e)
+                continue
+            results.append(True)
+            applied.append((operation, customer, transaction))
+            # 本批中同一会员之后的操作与已被修改的会员冲突
+            customers.pop(customer.id)
+        if not applied:
+            db.rollback()
+            return results
+        try:
+            # 取回插入的ID, 事件中带上记录ID
+            db.bulk_save_objects([transaction for _, _, transaction in applied], return_defaults=True)
+            table = Customer.__table__
+            db.execute(table.update()
+                            .where(and_(table.c.id == bindparam('customer_id'), table.c.status == 1,
+                                        table.c.update_time == bindparam('old_update_time')))
+                            .values(balance=bindparam('new_balance'), quantity=bindparam('new_quantity'),
+                                    score=bindparam('new_score'),
+                                    cellphone_consume_captcha=bindparam('new_captcha'),
+                                    cellphone_consume_captcha_expire_time=bindparam('new_captcha_expire_time'),
+                                    update_time=now),
+                       [{'customer_id': customer.id,
+                         'old_update_time': datetime.fromtimestamp(operation.oldUpdateTime),
+                         'new_balance': transaction.balance, 'new_quantity': transaction.quantity,
+                         'new_score': transaction.score,
+                         'new_captcha': customer.cellphoneConsumeCaptcha if operation.kind == 1 else None,
+                         'new_captcha_expire_time':
+                             customer.cellphoneConsumeCaptchaExpireTime if operation.kind == 1 else None}
+                        for operation, customer, transaction in applied])
+            changes = []
+            for operation, customer, transaction in applied:
+                changes.append(Customer._event('charged' if operation.kind == 1 else 'consumed', customer,
+                                               transaction))
+            events = [feed.record(db, change) for change in changes]
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        feed.publish(db, *events)
+        for seller_id in {o.sellerId for o, _, _ in applied}:
+            Seller.bump_data_version(seller_id)
+        for (operation, _, _), change in zip(applied, changes):
+            live.publish(Seller.live_channel(operation.sellerId),
+                         dict(change, updateTime=now.timestamp(), comments=operation.comments))
+        return results
+
+
+class CustomerRfm(BaseModel):
+    """会员的RFM分析结果, 由urvip.analytics批量计算
+    """
+    __tablename__ = 'customer_rfm'
+    customerId = Column('customer_id', BigInteger, primary_key=True, autoincrement=False)
+    sellerId = Column('seller_id', BigInteger, index=True)
+    # 累计值, 增量刷新时在此基础上累加
+    transactionCount = Column('transaction_count', Integer)
+    frequency = Column('frequency', Integer)
+    monetary = Column('monetary', Float)
+    firstTime = Column('first_time', DateTime)
+    lastTime = Column('last_time', DateTime)
+    # 每次刷新重新计算
+    recencyDays = Column('recency_days', Float)
+    recencyScore = Column('recency_score', Integer)
+    frequencyScore = Column('frequency_score', Integer)
+    monetaryScore = Column('monetary_score', Integer)
+    segment = Column('segment', String(20))
+    churnScore = Column('churn_score', Float)
+    suggestedLevel = Column('suggested_level', Integer)
+    updateTime = Column('update_time', DateTime)
+
+
+class RfmCheckpoint(BaseModel):
+    """商户RFM分析已处理到的充值、消费记录ID
+    """
+    __tablename__ = 'rfm_checkpoint'
+    sellerId = Column('seller_id', BigInteger, primary_key=True, autoincrement=False)
+    lastTransactionId = Column('last_transaction_id', BigInteger)
+    updateTime = Column('update_time', DateTime)